@@ -1,6 +1,6 @@
 from rest_framework import generics, status
 from rest_framework.response import Response
-from knox.models import AuthToken
+from accounts.auth import create_token
 from accounts.serializers import UserSerializer, LoginSerializer, RegisterSerializer
 
 
@@ -13,7 +13,7 @@ class RegisterAPI(generics.GenericAPIView):
         user = serializer.save()
         return Response({
             'user': UserSerializer(user, context=self.get_serializer_context()).data,
-            'token': AuthToken.objects.create(user)[1],
+            'token': create_token(user)[1],
         }, status.HTTP_201_CREATED)
 
 
@@ -26,5 +26,5 @@ class LoginAPI(generics.GenericAPIView):
         user = serializer.validated_data
         return Response({
             'user': UserSerializer(user, context=self.get_serializer_context()).data,
-            'token': AuthToken.objects.create(user)[1],
+            'token': create_token(user)[1],
         }, status.HTTP_200_OK)
@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+import knox.settings
+from knox.auth import TokenAuthentication
+from knox.models import AuthToken
+
+
+class TokenCacheEntry:
+    __slots__ = ('user', 'auth_token', 'valid_until')
+
+    def __init__(self, user, auth_token, valid_until):
+        self.user = user
+        self.auth_token = auth_token
+        self.valid_until = valid_until
+
+
+class TokenCache:
+    """Thread-safe LRU cache of validated tokens, every entry lives for `ttl` seconds at most"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Knox digest of the token of every entry to its key, so that invalidation does not scan the entries
+        self.keys = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.valid_until <= time.time():
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, user, auth_token):
+        valid_until = time.time() + self.ttl
+        if auth_token.expiry is not None:
+            valid_until = min(valid_until, auth_token.expiry.timestamp())
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = TokenCacheEntry(user, auth_token, valid_until)
+            self.keys[auth_token.digest] = key
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, digest):
+        with self.lock:
+            key = self.keys.get(digest)
+            if key is not None:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+
+    def remove(self, key):
+        # Called with the lock held
+        entry = self.entries.pop(key)
+        if self.keys.get(entry.auth_token.digest) == key:
+            del self.keys[entry.auth_token.digest]
+
+
+token_cache = TokenCache(max_size=getattr(settings, 'TOKEN_CACHE_MAX_SIZE', 10000),
+                         ttl=getattr(settings, 'TOKEN_CACHE_TTL', 60))
+
+
+@receiver(post_delete, sender=AuthToken)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    # Covers the logout views and the tokens knox removes once they are expired.
+    # Other processes keep a deleted token for `TOKEN_CACHE_TTL` seconds at most
+    token_cache.invalidate(instance.digest)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Knox token authentication that remembers validated tokens in memory,
+    so that most requests skip hashing the token and looking it up in the database
+    """
+    cache = token_cache
+
+    def authenticate_credentials(self, token):
+        key = hashlib.sha256(token).hexdigest()
+        entry = self.cache.get(key)
+        if entry is not None:
+            user, auth_token = entry.user, entry.auth_token
+        else:
+            user, auth_token = super().authenticate_credentials(token)
+            self.cache.set(key, user, auth_token)
+
+        if self.knox_settings.AUTO_REFRESH and auth_token.expiry:
+            self.renew_token(auth_token)
+        return user, auth_token
+
+    @property
+    def knox_settings(self):
+        # knox replaces its settings object when they change, so it is not imported by name
+        return knox.settings.knox_settings
+
+    def renew_token(self, auth_token):
+        # Unlike knox, keep the expiry stored in the database on the token instance
+        # when the write is skipped, since the instance outlives the request in the cache
+        new_expiry = timezone.now() + self.knox_settings.TOKEN_TTL
+        if (new_expiry - auth_token.expiry).total_seconds() > self.knox_settings.MIN_REFRESH_INTERVAL:
+            auth_token.expiry = new_expiry
+            auth_token.save(update_fields=('expiry', ))
+
+
+def create_token(user):
+    """Issues a new token, evicting the oldest live ones of the user beyond `TOKEN_LIMIT_PER_USER`"""
+    limit = getattr(settings, 'TOKEN_LIMIT_PER_USER', None)
+    with transaction.atomic():
+        if limit:
+            live = Q(expiry__isnull=True) | Q(expiry__gt=timezone.now())
+            kept = user.auth_token_set.filter(live).order_by('-created').values_list('pk', flat=True)[:limit - 1]
+            user.auth_token_set.exclude(pk__in=list(kept)).delete()
+        return AuthToken.objects.create(user)
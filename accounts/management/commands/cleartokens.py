@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from knox.models import AuthToken
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired authentication tokens in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of tokens deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between batches, to leave room for other writers')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        deleted = 0
+
+        while True:
+            with transaction.atomic():
+                # Tokens locked by a concurrent request are left for the next run
+                pks = list(AuthToken.objects.filter(expiry__lt=now)
+                                            .select_for_update(skip_locked=True)
+                                            .values_list('pk', flat=True)[:options['batch_size']])
+                if not pks:
+                    break
+                AuthToken.objects.filter(pk__in=pks).delete()
+            deleted += len(pks)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(f'Deleted {deleted} expired tokens')
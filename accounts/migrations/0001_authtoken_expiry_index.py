@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 13:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knox', '0007_auto_20190111_0542'),
+    ]
+
+    operations = [
+        # Lets `cleartokens` find expired tokens without scanning the whole table
+        migrations.RunSQL(
+            sql='CREATE INDEX knox_authtoken_expiry_idx ON knox_authtoken (expiry)',
+            reverse_sql='DROP INDEX knox_authtoken_expiry_idx',
+        ),
+    ]
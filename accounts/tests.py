@@ -1,9 +1,21 @@
+import asyncio
+import json
+import threading
+from datetime import timedelta
+from io import StringIO
+
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from knox.models import AuthToken
 
+from accounts import views
+from accounts.auth import TokenCache, token_cache
+
 
 class RegistrationTestCase(APITestCase):
 
@@ -33,6 +45,16 @@ class LoginTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['user']['username'], 'test')
 
+    @override_settings(TOKEN_LIMIT_PER_USER=2)
+    def test_login_evicts_oldest_tokens(self):
+        tokens = [self.client.post(self.login_url, data=self.credentials).data['token'] for _ in range(3)]
+        self.assertEqual(AuthToken.objects.filter(user=self.user).count(), 2)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + tokens[0])
+        self.assertEqual(self.client.get(reverse('chat-user')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + tokens[2])
+        self.assertEqual(self.client.get(reverse('chat-user')).status_code, status.HTTP_200_OK)
+
     def test_login_fail(self):
         wrong_credentials = {
             'username': 'incorrect',
@@ -62,3 +84,151 @@ class LogoutTestCase(APITestCase):
         self.client.force_authenticate(user=None)
         response = self.client.post(self.logout_url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenCacheTestCase(APITestCase):
+
+    user_chats_url = reverse('chat-user')
+    logout_url = reverse('logout')
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.auth_token, self.token = AuthToken.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def test_cached_token_skips_database(self):
+        self.assertEqual(self.client.get(self.user_chats_url).status_code, status.HTTP_200_OK)
+
+        # Only the version of the chat list and the chats of the user are queried
+        with self.assertNumQueries(2):
+            response = self.client.get(self.user_chats_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_logout_invalidates_cache(self):
+        self.assertEqual(self.client.get(self.user_chats_url).status_code, status.HTTP_200_OK)
+
+        response = self.client.post(self.logout_url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(self.user_chats_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_expired_token_not_cached(self):
+        self.assertEqual(self.client.get(self.user_chats_url).status_code, status.HTTP_200_OK)
+
+        self.auth_token.expiry = self.auth_token.expiry - timedelta(days=1)
+        self.auth_token.save()
+        token_cache.clear()
+
+        response = self.client.get(self.user_chats_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(REST_KNOX={'AUTO_REFRESH': True, 'MIN_REFRESH_INTERVAL': 300})
+    def test_refresh_interval_caps_writes(self):
+        self.assertEqual(self.client.get(self.user_chats_url).status_code, status.HTTP_200_OK)
+
+        # The expiry was just set by the login, so it is not written again
+        with self.assertNumQueries(2):
+            self.client.get(self.user_chats_url)
+
+        AuthToken.objects.filter(pk=self.auth_token.pk).update(expiry=self.auth_token.expiry - timedelta(hours=1))
+        token_cache.clear()
+        self.assertEqual(self.client.get(self.user_chats_url).status_code, status.HTTP_200_OK)
+        self.assertGreater(AuthToken.objects.get(pk=self.auth_token.pk).expiry, self.auth_token.expiry)
+
+    def test_invalidate_by_digest(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        tokens = [AuthToken.objects.create(user=self.user)[0] for _ in range(3)]
+        for i, auth_token in enumerate(tokens):
+            cache.set(f'key{i}', self.user, auth_token)
+
+        # The oldest entry was evicted along with its digest
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual(set(cache.keys), {tokens[1].digest, tokens[2].digest})
+
+        cache.invalidate(tokens[1].digest)
+        self.assertIsNone(cache.get('key1'))
+        self.assertIsNotNone(cache.get('key2'))
+        self.assertEqual(set(cache.keys), {tokens[2].digest})
+
+
+class ClearTokensTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        for _ in range(5):
+            AuthToken.objects.create(user=self.user, expiry=timedelta(hours=-1))
+        self.live_token = AuthToken.objects.create(user=self.user)[0]
+
+    def test_expired_tokens_deleted(self):
+        out = StringIO()
+        call_command('cleartokens', batch_size=2, stdout=out)
+        self.assertIn('Deleted 5 expired tokens', out.getvalue())
+        self.assertEqual(list(AuthToken.objects.all()), [self.live_token])
+
+
+class AsyncAuthViewsTestCase(TransactionTestCase):
+
+    credentials = {
+        'username': 'test',
+        'password': 'test'
+    }
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.hashing_pool = views.hashing_pool
+
+    def tearDown(self):
+        views.hashing_pool = self.hashing_pool
+
+    def post(self, view, data):
+        request = self.factory.post('/', data=json.dumps(data), content_type='application/json')
+        return async_to_sync(view)(request)
+
+    def test_register_and_login(self):
+        response = self.post(views.register, self.credentials)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(response.content)['user']['username'], 'test')
+
+        response = self.post(views.login, self.credentials)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        token = json.loads(response.content)['token']
+        self.assertEqual(AuthToken.objects.filter(user__username='test').count(), 2)
+
+        response = self.client.get(reverse('chat-user'), HTTP_AUTHORIZATION='Token ' + token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_login_fail(self):
+        response = self.post(views.login, {'username': 'incorrect', 'password': 'incorrect'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content)['non_field_errors'], ['Incorrect credentials'])
+
+    def test_busy_pool_refuses(self):
+        views.hashing_pool = views.HashingPool(workers=1, max_pending=1)
+        release = threading.Event()
+        request = self.factory.post('/', data=json.dumps(self.credentials), content_type='application/json')
+
+        async def login_while_busy():
+            # Takes the only slot until the login is answered
+            pending = asyncio.ensure_future(views.hashing_pool.run(release.wait))
+            await asyncio.sleep(0)
+            try:
+                return await views.login(request)
+            finally:
+                release.set()
+                await pending
+
+        response = async_to_sync(login_while_busy)()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+
+        # The slot is free again once the pending call is done
+        response = self.post(views.login, self.credentials)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_unbounded_pool_admits(self):
+        views.hashing_pool = views.HashingPool(workers=1, max_pending=0)
+
+        response = self.post(views.register, self.credentials)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
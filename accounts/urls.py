@@ -1,11 +1,19 @@
+from django.conf import settings
 from django.urls import path
 from knox import views as knox_views
 
+from accounts import views
 from accounts.api import RegisterAPI, LoginAPI
 
 
+if settings.ASYNC_AUTH_VIEWS:
+    register_view, login_view = views.register, views.login
+else:
+    register_view, login_view = RegisterAPI.as_view(), LoginAPI.as_view()
+
+
 urlpatterns = [
-    path('api/accounts/register', RegisterAPI.as_view(), name='register'),
-    path('api/accounts/login', LoginAPI.as_view(), name='login'),
+    path('api/accounts/register', register_view, name='register'),
+    path('api/accounts/login', login_view, name='login'),
     path('api/accounts/logout', knox_views.LogoutView.as_view(), name='logout')
 ]
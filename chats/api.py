@@ -1,9 +1,28 @@
-from django.core.exceptions import ObjectDoesNotExist
-from rest_framework import generics, permissions, status
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.http import StreamingHttpResponse
+from rest_framework import generics, permissions, serializers, status
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 
-from chats.serializers import ChatSerializer, ChatPreviewSerializer, MessageSerializer, MessagePreviewSerializer
-from chats.models import Chat
+from chats.serializers import ChatSerializer, ChatBootstrapSerializer, ChatInboxSerializer, ChatPreviewSerializer, \
+    MessageBatchSerializer, MessageSerializer, MessagePreviewSerializer
+from chats.cache import tail_cache
+from chats.conditional import ConditionalListMixin
+from chats.export import export_messages
+from chats.models import Chat, Membership, Message
+from chats.pagination import ChatInboxPagination, MessageKeysetPagination
+from chats.pubsub import chat_channel, get_broker
+from chats.renderers import FastJSONRenderer, get_history_renderers
+from chats.representations import CHAT_PREVIEW_VALUES, MESSAGE_VALUES, represent_chats, represent_messages, \
+    represent_messages_compact
+from chats.sharding import add_usernames, group_by_shard, join_users, on_all_shards, scatter, shard_for, shard_values
+from oil_test.postgresql_pool.pool import get_pool_stats
+from oil_test.replicas import ReplicaReadMixin
 
 
 class ChatCreateAPI(generics.CreateAPIView):
@@ -32,37 +51,300 @@ class MessageCreateAPI(generics.CreateAPIView):
         serializer = self.serializer_class(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
         message = serializer.save(author=request.user, chat_id=kwargs.get('pk'))
+        data = MessageSerializer(message, context=self.get_serializer_context()).data
+        transaction.on_commit(lambda: get_broker().publish(chat_channel(message.chat_id), {'message': data}))
+        return Response({
+            'message': data
+        }, status=status.HTTP_201_CREATED)
+
+
+class MessageBatchCreateAPI(generics.CreateAPIView):
+    """Sends a list of `{chat_id, text}` messages at once, every one of them succeeds or fails on its own"""
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = MessageBatchSerializer
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save(author=request.user, messages=request.data.get('messages'))
+
+        response = []
+        for result in results:
+            if isinstance(result, str):
+                response.append({'error': result})
+                continue
+            data = MessageSerializer(result, context=self.get_serializer_context()).data
+            transaction.on_commit(lambda chat_id=result.chat_id, data=data:
+                                  get_broker().publish(chat_channel(chat_id), {'message': data}))
+            response.append({'message': data})
+
         return Response({
-            'message': MessageSerializer(message, context=self.get_serializer_context()).data
+            'results': response
         }, status=status.HTTP_201_CREATED)
 
 
-class ChatHistoryAPI(generics.ListAPIView):
+class ChatHistoryAPI(ReplicaReadMixin, ConditionalListMixin, generics.ListAPIView):
     permission_classes = [
         permissions.IsAuthenticated,
     ]
     serializer_class = MessagePreviewSerializer
+    pagination_class = MessageKeysetPagination
+    renderer_classes = get_history_renderers() + [BrowsableAPIRenderer]
 
     def list(self, request, *args, **kwargs):
         chat_id = kwargs.get('pk')
 
-        try:
-            chat = Chat.objects.get(pk=chat_id)
-        except ObjectDoesNotExist:
+        version = Chat.objects.using(shard_for(chat_id)).history_version(chat_id, request.user)
+        if version is None:
             return Response('Chat does not exist', status=status.HTTP_404_NOT_FOUND)
 
-        if request.user not in chat.participants.all():
+        generation, last_message_id = version
+        return self.conditional_response(request, (chat_id, generation, last_message_id),
+                                         lambda: self.get_history(request, chat_id, generation))
+
+    def get_history(self, request, chat_id, generation):
+        paginator = self.paginator
+        paginator.read_request(request)
+
+        # The newest page of recently read chats is served from memory
+        rows = None
+        if paginator.before is None and not paginator.ascending:
+            rows = tail_cache.latest(chat_id, generation, paginator.page_size + 1)
+        if rows is not None:
+            page = paginator.paginate_rows(rows)
+        else:
+            page = add_usernames(self.paginate_queryset(self.get_queryset()), 'author')
+        if getattr(request.accepted_renderer, 'compact_messages', False):
+            return self.get_paginated_response(represent_messages_compact(page))
+        return self.get_paginated_response(represent_messages(page))
+
+    def get_queryset(self):
+        chat_id = self.kwargs.get('pk')
+        messages = Message.objects.using(shard_for(chat_id)).filter(chat_id=chat_id)
+        return messages.values(*shard_values(MESSAGE_VALUES))
+
+
+class ChatExportAPI(generics.GenericAPIView):
+    """Streams the whole history of the chat as NDJSON"""
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+
+    def get(self, request, *args, **kwargs):
+        chat_id = kwargs.get('pk')
+
+        if not Chat.objects.using(shard_for(chat_id)).has_participant(chat_id, request.user):
             return Response('Chat does not exist', status=status.HTTP_404_NOT_FOUND)
 
-        serializer = MessagePreviewSerializer(chat.messages, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        response = StreamingHttpResponse(export_messages(chat_id), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="chat-{chat_id}.ndjson"'
+        return response
 
 
-class ChatUserAPI(generics.ListAPIView):
+class ChatUserAPI(ReplicaReadMixin, ConditionalListMixin, generics.ListAPIView):
     permission_classes = [
         permissions.IsAuthenticated,
     ]
     serializer_class = ChatPreviewSerializer
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    def get_queryset(self):
+        # Ordered by the membership rather than the chat, so that the `(user, chat)` index yields the order
+        return self.request.user.chats.select_related('creator').order_by('memberships__chat_id')
+
+    def get_rows(self):
+        # The rows of the shards are merged on the field they are ordered by
+        return self.get_queryset().values(*shard_values(CHAT_PREVIEW_VALUES), 'memberships__chat_id')
+
+    def list(self, request, *args, **kwargs):
+        # Every shard holds a part of the chats of the user, they are all asked at once
+        versions = scatter(lambda using: Chat.objects.using(using).list_version(request.user))
+        return self.conditional_response(request, (request.user.pk, *versions), self.get_chats)
+
+    def get_chats(self):
+        rows = on_all_shards(self.get_rows())
+        return Response(represent_chats(add_usernames(list(rows), 'creator')), status=status.HTTP_200_OK)
+
+
+class ChatInboxAPI(generics.ListAPIView):
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = ChatInboxSerializer
+    pagination_class = ChatInboxPagination
 
     def get_queryset(self):
-        return self.request.user.chats
+        return on_all_shards(join_users(Chat.objects.inbox(self.request.user), 'creator', 'last_message__author'))
+
+
+class ChatReadAPI(generics.GenericAPIView):
+    """Marks the messages of the chat up to `message_id`, or all of them, as read"""
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+
+    def post(self, request, *args, **kwargs):
+        last_message = Chat.objects.filter(pk=OuterRef('chat_id')).values('last_message_id')[:1]
+        last_message_id = Coalesce(Subquery(last_message), 0)
+        message_id = request.data.get('message_id')
+        if message_id is None:
+            message_id = last_message_id
+        else:
+            try:
+                # Ids past the last message would hide the messages sent later for good
+                message_id = Least(int(message_id), last_message_id)
+            except (TypeError, ValueError):
+                raise serializers.ValidationError('`message_id` parameter should be an integer')
+
+        # The read marker never moves backwards
+        updated = Membership.objects.using(shard_for(kwargs.get('pk'))) \
+                                    .filter(chat_id=kwargs.get('pk'), user_id=request.user.pk) \
+                                    .update(last_read_message_id=Greatest(F('last_read_message_id'), message_id))
+        if not updated:
+            return Response('Chat does not exist', status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ChatSyncAPI(generics.GenericAPIView):
+    """
+    Returns the messages sent after `since=<chat_id>:<message_id>` for every given chat.
+    With `timeout=<seconds>` an empty answer is held back until a new message arrives.
+    """
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = MessagePreviewSerializer
+    max_messages = MessageKeysetPagination.max_page_size
+
+    def get(self, request, *args, **kwargs):
+        since = self.parse_since(request.query_params.getlist('since'))
+        timeout = self.parse_timeout(request.query_params.get('timeout', 0))
+
+        since = {
+            chat_id: since[chat_id]
+            for using, chat_ids in group_by_shard(since).items()
+            for chat_id in Chat.objects.using(using).with_participant(request.user).filter(pk__in=chat_ids)
+                                                    .values_list('pk', flat=True)
+        }
+        if not since:
+            return Response({'has_more': False, 'chats': []}, status=status.HTTP_200_OK)
+
+        newer = on_all_shards(Message.objects.filter(self.newer_messages(since)).order_by('created_at', 'id')
+                                             .values('chat_id', *shard_values(MESSAGE_VALUES)))
+        deadline = time.monotonic() + timeout
+        with get_broker().listen([chat_channel(chat_id) for chat_id in since]) as listener:
+            messages = list(newer[:self.max_messages + 1])
+            while not messages and time.monotonic() < deadline:
+                listener.wait(min(deadline - time.monotonic(), settings.CHATS_SYNC_POLL_INTERVAL))
+                messages = list(newer[:self.max_messages + 1])
+
+        has_more = len(messages) > self.max_messages
+        chats = {}
+        for message in add_usernames(messages[:self.max_messages], 'author'):
+            chats.setdefault(message['chat_id'], []).append(message)
+
+        return Response({
+            'has_more': has_more,
+            'chats': [
+                {'id': chat_id, 'messages': represent_messages(chat_messages)}
+                for chat_id, chat_messages in chats.items()
+            ],
+        }, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def parse_since(values):
+        since = {}
+        for value in values:
+            try:
+                chat_id, message_id = map(int, value.split(':'))
+            except ValueError:
+                raise serializers.ValidationError('`since` parameter should look like <chat_id>:<message_id>')
+            since[chat_id] = message_id
+        return since
+
+    @staticmethod
+    def parse_timeout(value):
+        try:
+            timeout = float(value)
+        except ValueError:
+            raise serializers.ValidationError('`timeout` parameter should be a number of seconds')
+        return min(max(timeout, 0), settings.CHATS_SYNC_MAX_TIMEOUT)
+
+    @staticmethod
+    def newer_messages(since):
+        # Follow the ordering of the history, so the last seen message is located by its `(created_at, id)` key
+        positions = {
+            chat_id: (created_at, pk)
+            for chat_id, created_at, pk in on_all_shards(Message.objects.filter(pk__in=since.values())
+                                                                        .values_list('chat_id', 'created_at', 'id'))
+            if since.get(chat_id) == pk
+        }
+
+        condition = Q(pk__in=[])
+        for chat_id, message_id in since.items():
+            if chat_id in positions:
+                condition |= Q(chat_id=chat_id) & MessageKeysetPagination.newer_than(positions[chat_id])
+            else:
+                condition |= Q(chat_id=chat_id, id__gt=message_id)
+        return condition
+
+
+class ChatBootstrapAPI(generics.ListAPIView):
+    """Returns every chat of the user together with its `limit` newest messages"""
+    permission_classes = [
+        permissions.IsAuthenticated,
+    ]
+    serializer_class = ChatBootstrapSerializer
+    limit = 20
+    max_limit = 50
+
+    def list(self, request, *args, **kwargs):
+        limit = self.get_limit()
+        chats = list(on_all_shards(join_users(self.request.user.chats.order_by('pk'), 'creator')))
+        messages = [
+            message
+            for shard_messages in scatter(lambda using: list(Message.objects.db_manager(using)
+                                                                            .latest_per_chat(request.user, limit)))
+            for message in shard_messages
+        ]
+
+        # Messages of a chat created after the chats were listed are left for the next request
+        latest_messages = {chat.pk: [] for chat in chats}
+        messages = [message for message in messages if message.chat_id in latest_messages]
+        prefetch_related_objects(messages, 'author')
+        for message in messages:
+            latest_messages[message.chat_id].append(message)
+        for chat in chats:
+            chat.latest_messages = latest_messages[chat.pk]
+
+        serializer = self.get_serializer(chats, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.query_params['limit'])
+        except (KeyError, ValueError):
+            return self.limit
+        return min(max(limit, 0), self.max_limit)
+
+
+class ChatCacheStatsAPI(generics.GenericAPIView):
+    """Hit rate of the history tail cache of the process that serves the request"""
+    permission_classes = [
+        permissions.IsAdminUser,
+    ]
+
+    def get(self, request, *args, **kwargs):
+        return Response(tail_cache.stats(), status=status.HTTP_200_OK)
+
+
+class DatabasePoolStatsAPI(generics.GenericAPIView):
+    """Usage of the database connection pools of the process that serves the request, by database alias"""
+    permission_classes = [
+        permissions.IsAdminUser,
+    ]
+
+    def get(self, request, *args, **kwargs):
+        return Response(get_pool_stats(), status=status.HTTP_200_OK)
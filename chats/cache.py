@@ -0,0 +1,182 @@
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from chats.models import Message
+from chats.representations import MESSAGE_VALUES
+from chats.sharding import add_usernames, shard_for, shard_values
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_microseconds(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def message_row(message):
+    """The `values()` row of a message that was just created, with its author at hand"""
+    return {
+        'id': message.pk,
+        'seq': message.seq,
+        'author_id': message.author_id,
+        'author__username': message.author.username,
+        'text': message.text,
+        'created_at': message.created_at,
+    }
+
+
+class ChatTail:
+    """
+    The newest messages of a chat as of `generation`, oldest first, kept in parallel arrays.
+    `complete` tells that the chat has no older messages than these
+    """
+    __slots__ = ('generation', 'complete', 'ids', 'seqs', 'author_ids', 'created_at', 'texts', 'usernames')
+
+    def __init__(self, generation, complete):
+        self.generation = generation
+        self.complete = complete
+        self.ids = array('q')
+        self.seqs = array('q')
+        self.author_ids = array('q')
+        self.created_at = array('q')
+        self.texts = []
+        self.usernames = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def insert(self, row):
+        # Messages are ordered by `(created_at, id)` like the history, and almost always land at the end
+        created_at = to_microseconds(row['created_at'])
+        position = len(self.ids)
+        while position and (self.created_at[position - 1], self.ids[position - 1]) > (created_at, row['id']):
+            position -= 1
+        if position and self.ids[position - 1] == row['id']:
+            return
+
+        self.ids.insert(position, row['id'])
+        self.seqs.insert(position, row['seq'])
+        self.author_ids.insert(position, row['author_id'])
+        self.created_at.insert(position, created_at)
+        self.texts.insert(position, row['text'])
+        self.usernames[row['author_id']] = row['author__username']
+
+    def trim(self, size):
+        extra = len(self.ids) - size
+        if extra > 0:
+            del self.ids[:extra], self.seqs[:extra], self.author_ids[:extra], self.created_at[:extra], self.texts[:extra]
+            self.usernames = {author_id: self.usernames[author_id] for author_id in set(self.author_ids)}
+            self.complete = False
+
+    def latest(self, count):
+        """`values()`-like rows of the `count` newest messages, newest first"""
+        rows = []
+        for i in reversed(range(max(len(self.ids) - count, 0), len(self.ids))):
+            author_id = self.author_ids[i]
+            rows.append({
+                'id': self.ids[i],
+                'seq': self.seqs[i],
+                'author_id': author_id,
+                'author__username': self.usernames[author_id],
+                'text': self.texts[i],
+                'created_at': EPOCH + timedelta(microseconds=self.created_at[i]),
+            })
+        return rows
+
+
+class TailCache:
+    """
+    Per-process LRU cache of the newest `max_messages` messages of up to `max_chats` chats.
+
+    A tail is only used while its generation matches the one of the chat in the database,
+    so messages sent, changed or deleted by other processes are never missed
+    """
+
+    def __init__(self, max_chats, max_messages):
+        self.max_chats = max_chats
+        self.max_messages = max_messages
+        self.lock = threading.Lock()
+        self.tails = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, chat_id):
+        return int(chat_id) in self.tails
+
+    def latest(self, chat_id, generation, count):
+        """The `count` newest messages of the chat, newest first, loading them on a miss"""
+        if not self.max_chats or count > self.max_messages:
+            return None
+
+        chat_id = int(chat_id)
+        with self.lock:
+            tail = self.tails.get(chat_id)
+            if tail is not None and tail.generation == generation and (len(tail) >= count or tail.complete):
+                self.tails.move_to_end(chat_id)
+                self.hits += 1
+                return tail.latest(count)
+            self.misses += 1
+
+        rows = list(Message.objects.using(shard_for(chat_id)).filter(chat_id=chat_id).order_by('-created_at', '-id')
+                                   .values(*shard_values(MESSAGE_VALUES))[:self.max_messages])
+        add_usernames(rows, 'author')
+        self.set(chat_id, generation, rows)
+        return rows[:count]
+
+    def set(self, chat_id, generation, rows):
+        chat_id = int(chat_id)
+        tail = ChatTail(generation, complete=len(rows) < self.max_messages)
+        for row in reversed(rows):
+            tail.insert(row)
+
+        with self.lock:
+            current = self.tails.get(chat_id)
+            # A slower reader must not replace a tail that is already newer
+            if current is not None and current.generation > generation:
+                return
+            self.tails[chat_id] = tail
+            self.tails.move_to_end(chat_id)
+            while len(self.tails) > self.max_chats:
+                self.tails.popitem(last=False)
+
+    def add(self, chat_id, generation, rows):
+        """Writes messages through once their transaction committed the chat at `generation`"""
+        chat_id = int(chat_id)
+        with self.lock:
+            tail = self.tails.get(chat_id)
+            if tail is None:
+                return
+            if tail.generation != generation - 1:
+                # Another process changed the chat in between, the next read reloads it
+                if tail.generation < generation:
+                    del self.tails[chat_id]
+                return
+            for row in rows:
+                tail.insert(row)
+            tail.trim(self.max_messages)
+            tail.generation = generation
+            self.tails.move_to_end(chat_id)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'chats': len(self.tails),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else None,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.tails.clear()
+            self.hits = self.misses = 0
+
+
+tail_cache = TailCache(max_chats=getattr(settings, 'CHATS_TAIL_CACHE_CHATS', 1000),
+                       max_messages=getattr(settings, 'CHATS_TAIL_CACHE_MESSAGES', 256))
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from knox.settings import knox_settings
+from rest_framework.exceptions import AuthenticationFailed
+
+from accounts.auth import CachedTokenAuthentication
+from chats.models import Chat
+from chats.pubsub import chat_channel, get_broker
+from chats.sharding import shard_for
+
+
+CHAT_PATH = re.compile(r'^/ws/chats/(?P<pk>\d+)/?$')
+
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+
+
+def database_sync_to_async(func):
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper)
+
+
+def get_token(scope):
+    """Browsers cannot set headers on a WebSocket, so the token may be passed as `?token=` as well"""
+    prefix = knox_settings.AUTH_HEADER_PREFIX.lower().encode()
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            auth = value.split()
+            if len(auth) == 2 and auth[0].lower() == prefix:
+                return auth[1]
+    token = parse_qs(scope.get('query_string', b'').decode('latin1')).get('token')
+    return token[0].encode() if token else None
+
+
+@database_sync_to_async
+def authenticate(token):
+    try:
+        user, _ = CachedTokenAuthentication().authenticate_credentials(token)
+    except AuthenticationFailed:
+        return None
+    return user
+
+
+@database_sync_to_async
+def has_participant(chat_id, user):
+    return Chat.objects.using(shard_for(chat_id)).has_participant(chat_id, user)
+
+
+async def chat_consumer(scope, receive, send, chat_id):
+    """Pushes every message sent to the chat to a connected participant, client frames are ignored"""
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    token = get_token(scope)
+    user = await authenticate(token) if token else None
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+    if not await has_participant(chat_id, user):
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+
+    subscription = get_broker().subscribe(chat_channel(chat_id))
+    await send({'type': 'websocket.accept'})
+
+    receiving = asyncio.ensure_future(receive())
+    publishing = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait({receiving, publishing}, return_when=asyncio.FIRST_COMPLETED)
+            if publishing in done:
+                await send({'type': 'websocket.send', 'text': json.dumps(publishing.result())})
+                publishing = asyncio.ensure_future(subscription.get())
+            if receiving in done:
+                if receiving.result()['type'] == 'websocket.disconnect':
+                    break
+                receiving = asyncio.ensure_future(receive())
+    finally:
+        receiving.cancel()
+        publishing.cancel()
+        subscription.close()
+
+
+async def websocket_application(scope, receive, send):
+    match = CHAT_PATH.match(scope['path'])
+    if match is None:
+        await receive()
+        await send({'type': 'websocket.close'})
+        return
+    await chat_consumer(scope, receive, send, int(match.group('pk')))
@@ -0,0 +1,27 @@
+import json
+from itertools import islice
+
+from chats.models import Message
+from chats.representations import MESSAGE_VALUES, get_datetime_formatter, represent_message
+from chats.sharding import add_usernames, shard_for, shard_values
+
+
+def export_messages(chat_id, chunk_size=2000):
+    """
+    Yields the history of the chat as NDJSON lines, one `MessagePreviewSerializer`-shaped object per line.
+
+    Rows are read through a server-side cursor in chunks and the authors are joined in,
+    or looked up chunk by chunk on a sharded setup, so the memory used does not depend on the size of the chat.
+    """
+    format_datetime = get_datetime_formatter()
+    rows = Message.objects.using(shard_for(chat_id)).filter(chat_id=chat_id).order_by('created_at', 'id') \
+                          .values(*shard_values(MESSAGE_VALUES)) \
+                          .iterator(chunk_size=chunk_size)
+
+    while True:
+        chunk = add_usernames(list(islice(rows, chunk_size)), 'author')
+        if not chunk:
+            return
+        for row in chunk:
+            line = json.dumps(represent_message(row, format_datetime), ensure_ascii=False, separators=(',', ':'))
+            yield line.encode('utf-8') + b'\n'
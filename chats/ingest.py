@@ -0,0 +1,107 @@
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+
+from chats.cache import message_row, tail_cache
+from chats.models import Chat, Message
+
+
+class PendingItem:
+    __slots__ = ('value', 'result', 'error', 'done')
+
+    def __init__(self, value):
+        self.value = value
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """
+    Groups the items submitted by concurrent threads and flushes every group at once.
+
+    The thread that submits into an empty group leads it: it waits for up to `window` seconds,
+    or until `max_batch` items are pending, flushes the whole group and wakes the other threads up.
+    No thread waits longer than the window and a single flush, however many threads submit
+    """
+
+    def __init__(self, flush, window, max_batch):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.filled = threading.Condition(self.lock)
+        self.pending = []
+
+    def submit(self, value):
+        item = PendingItem(value)
+        with self.lock:
+            self.pending.append(item)
+            leader = len(self.pending) == 1
+            if len(self.pending) >= self.max_batch:
+                self.filled.notify()
+
+            if leader:
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.filled.wait(remaining)
+                group, self.pending = self.pending, []
+
+        if leader:
+            self.run(group)
+        else:
+            item.done.wait()
+
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def run(self, group):
+        try:
+            results = self.flush([item.value for item in group])
+        except Exception as e:
+            for item in group:
+                item.error = e
+        else:
+            for item, result in zip(group, results):
+                item.result = result
+        finally:
+            for item in group:
+                item.done.set()
+
+
+def write_messages(messages, using=None):
+    """
+    Inserts a group of messages of one shard in one transaction and writes them through to the tail cache.
+    Messages of chats deleted meanwhile are not sent and keep no id, the rest of the group is committed
+    """
+    with transaction.atomic(using=using):
+        sent = Message.objects.db_manager(using).bulk_send(messages)
+        cached = {message.chat_id for message in sent if message.chat_id in tail_cache}
+        generations = dict(Chat.objects.using(using).filter(pk__in=cached)
+                                       .values_list('pk', 'generation')) if cached else {}
+
+    for chat_id, generation in generations.items():
+        tail_cache.add(chat_id, generation,
+                       [message_row(message) for message in sent if int(message.chat_id) == chat_id])
+    return messages
+
+
+message_committers = {}
+message_committers_lock = threading.Lock()
+
+
+def get_message_committer(using):
+    """Messages are grouped per shard, as a transaction cannot span several databases"""
+    with message_committers_lock:
+        if using not in message_committers:
+            message_committers[using] = GroupCommitter(partial(write_messages, using=using),
+                                                       window=getattr(settings, 'CHATS_GROUP_COMMIT_WINDOW', 0.005),
+                                                       max_batch=getattr(settings, 'CHATS_GROUP_COMMIT_MAX_BATCH', 100))
+        return message_committers[using]
@@ -0,0 +1,64 @@
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from chats.models import Chat, Message
+from chats.renderers import FastJSONRenderer
+from chats.representations import MESSAGE_VALUES, represent_messages
+from chats.serializers import MessagePreviewSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compares rendering message lists with DRF serializers and with the values() fast path. ' \
+           'The generated messages are rolled back afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=1, help='The best of this many runs is reported')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+
+        self.stdout.write(f'{"rows":>8} {"drf":>10} {"drf+join":>10} {"fast":>10} {"speedup":>8}')
+        with transaction.atomic():
+            author = get_user_model().objects.create(username=f'benchmark-{uuid.uuid4().hex[:8]}')
+            chat = Chat.objects.create(creator=author)
+
+            created = 0
+            for size in sorted(options['sizes']):
+                Message.objects.bulk_create(
+                    (Message(chat=chat, author=author, text=f'Message #{i}', seq=i + 1) for i in range(created, size)),
+                    batch_size=5000,
+                )
+                created = max(created, size)
+
+                def messages():
+                    return Message.objects.filter(chat=chat).order_by('created_at', 'id')[:size]
+
+                # How `ChatHistoryAPI` rendered messages before, with a query per author
+                drf, expected = self.measure(
+                    lambda: JSONRenderer().render(MessagePreviewSerializer(messages(), many=True).data))
+                drf_join, _ = self.measure(
+                    lambda: JSONRenderer().render(
+                        MessagePreviewSerializer(messages().select_related('author'), many=True).data))
+                fast, output = self.measure(
+                    lambda: FastJSONRenderer().render(represent_messages(messages().values(*MESSAGE_VALUES))))
+
+                if output != expected:
+                    raise CommandError(f'The outputs differ for {size} rows')
+                self.stdout.write(f'{size:>8} {drf:>9.3f}s {drf_join:>9.3f}s {fast:>9.3f}s {drf / fast:>7.1f}x')
+
+            transaction.set_rollback(True)
+
+    def measure(self, func):
+        best, result = None, None
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
@@ -0,0 +1,100 @@
+import re
+from types import SimpleNamespace
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from chats.api import ChatHistoryAPI, ChatInboxAPI, ChatUserAPI
+from chats.models import Chat
+from chats.pagination import MessageKeysetPagination
+from chats.sharding import MergedQuerySet
+
+
+# Plan fragments that mean a query is not served by an index
+SCAN_PATTERNS = {
+    'postgresql': re.compile(r'Seq Scan'),
+    'sqlite': re.compile(r'\bSCAN\b'),
+}
+SORT_PATTERNS = {
+    'postgresql': re.compile(r'\bSort\b'),
+    'sqlite': re.compile(r'TEMP B-TREE'),
+}
+
+
+def unwrap(queryset):
+    # Plans are read from the default database, not from every shard
+    return queryset.queryset if isinstance(queryset, MergedQuerySet) else queryset
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN on the hot queries of the chats API and fails if any of them ' \
+           'falls back to a sequential scan or a sort'
+
+    def handle(self, *args, **options):
+        if connection.vendor not in SCAN_PATTERNS:
+            raise CommandError(f'Unsupported database vendor: {connection.vendor}')
+        scan, sort = SCAN_PATTERNS[connection.vendor], SORT_PATTERNS[connection.vendor]
+
+        failed = []
+        for name, queryset, sorts in self.hot_queries():
+            plan = self.explain(queryset)
+            if scan.search(plan) or (not sorts and sort.search(plan)):
+                failed.append(name)
+                self.stdout.write(self.style.ERROR(f'FAIL {name}'))
+            elif sorts:
+                self.stdout.write(self.style.SUCCESS(f'OK   {name} (sorts the chats of the user)'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'OK   {name}'))
+            if options['verbosity'] > 1:
+                self.stdout.write(plan)
+
+        if failed:
+            raise CommandError(f'Queries without a suitable index: {", ".join(failed)}')
+
+    @staticmethod
+    def hot_queries():
+        """
+        `(name, queryset, sorts)` of the queries the views run, taken from the views themselves.
+        `sorts` marks the queries that order the chats of a user by a computed value, which no index can serve
+        """
+        # The values do not change the shape of the plans, any ids will do
+        chat_id, user = 1, get_user_model()(pk=1)
+        request = SimpleNamespace(user=user)
+
+        def history(**cursor):
+            paginator = MessageKeysetPagination()
+            paginator.page_size = paginator.max_page_size
+            paginator.before = paginator.after = paginator.after_seq = None
+            for name, value in cursor.items():
+                setattr(paginator, name, value)
+            return paginator.page_queryset(ChatHistoryAPI(kwargs={'pk': chat_id}).get_queryset())
+
+        chats = Chat.objects.with_participant(user).filter(pk__in=[chat_id])
+        inbox = ChatInboxAPI(request=request)
+        position = (timezone.now(), 1)
+        return [
+            ('chat-membership', chats.values_list('pk', flat=True), False),
+            ('history-version', Chat.objects.history_version_query(chat_id, user), False),
+            ('history-latest', history(), False),
+            ('history-before', history(before=position), False),
+            ('history-after', history(after=position), False),
+            ('history-after-seq', history(after_seq=1), False),
+            ('chat-list-version', Chat.objects.list_version_query(user), False),
+            ('chat-list', ChatUserAPI(request=request).get_rows(), False),
+            ('inbox', unwrap(inbox.get_queryset()).order_by(*inbox.pagination_class.ordering)
+                                                   [:inbox.pagination_class.max_page_size + 1], True),
+        ]
+
+    @staticmethod
+    def explain(queryset):
+        connection = connections[queryset.db]
+        with transaction.atomic(using=queryset.db):
+            if connection.vendor == 'postgresql':
+                # Small tables are always cheaper to scan, so make the planner prove
+                # that an index can serve the query instead of trusting its costs
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                    cursor.execute('SET LOCAL enable_sort = off')
+            return queryset.explain()
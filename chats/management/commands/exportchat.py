@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.export import export_messages
+from chats.models import Chat
+from chats.sharding import shard_for
+
+
+class Command(BaseCommand):
+    help = 'Exports the whole history of a chat as NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat_id', type=int)
+        parser.add_argument('--output', help='File to write to, standard output by default')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Number of messages fetched from the database at once')
+
+    def handle(self, *args, **options):
+        if not Chat.objects.using(shard_for(options['chat_id'])).filter(pk=options['chat_id']).exists():
+            raise CommandError('Chat does not exist')
+
+        lines = export_messages(options['chat_id'], chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line.decode('utf-8'), ending='')
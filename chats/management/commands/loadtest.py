@@ -0,0 +1,254 @@
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import count
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+from django.urls import reverse
+from knox.models import AuthToken
+from rest_framework.test import APIClient
+
+from chats.models import Chat
+from chats.sharding import scatter
+
+
+PASSWORD = 'loadtest'
+DEFAULT_MIX = 'register=1,login=2,create-chat=2,send-message=20,chat-history=20,chat-user=10'
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Sends a mix of API requests from several threads and reports the throughput, the latency ' \
+           'and the queries of every endpoint as JSON. The requests are handled in-process by the test client, ' \
+           'the users, chats and messages it creates are deleted afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Number of measured requests')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of threads sending requests')
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help=f'Relative weights of the endpoints, "{DEFAULT_MIX}" by default')
+        parser.add_argument('--users', type=int, default=50, help='Number of users created beforehand')
+        parser.add_argument('--chats', type=int, default=20, help='Number of chats created beforehand')
+        parser.add_argument('--participants', type=int, default=5, help='Largest number of participants of a chat')
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of messages sent to every chat beforehand')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random choices of the requests')
+        parser.add_argument('--output', help='File to write the report to, standard output by default')
+        parser.add_argument('--keep', action='store_true', help='Keeps the created users, chats and messages')
+
+    def handle(self, *args, **options):
+        self.mix = self.parse_mix(options['mix'])
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('At least one request and one thread are needed')
+        if options['users'] < 2 or options['chats'] < 1 or options['participants'] < 2:
+            raise CommandError('At least two users and one chat of two participants are needed')
+
+        self.prefix = f'loadtest-{uuid.uuid4().hex[:8]}-'
+        self.usernames = count()
+        self.seed = options['seed']
+        rng = random.Random(self.seed)
+
+        # The test client sends requests to "testserver". Logins must not evict the tokens
+        # the other requests of the same users are sent with
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], TOKEN_LIMIT_PER_USER=None):
+            try:
+                self.prepare(rng, options)
+                report = self.run(rng, options)
+            finally:
+                if not options['keep']:
+                    self.clean_up()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def parse_mix(self, value):
+        mix = {}
+        for item in value.split(','):
+            name, _, weight = item.partition('=')
+            name = name.strip()
+            if name not in self.OPERATIONS:
+                raise CommandError(f'Unknown endpoint "{name}", choose from {", ".join(self.OPERATIONS)}')
+            try:
+                mix[name] = float(weight or 1)
+            except ValueError:
+                raise CommandError(f'Weight of "{name}" has to be a number')
+        if not any(weight > 0 for weight in mix.values()):
+            raise CommandError('At least one endpoint needs a positive weight')
+        return mix
+
+    def prepare(self, rng, options):
+        """Creates the users, their tokens and the chats the measured requests use"""
+        password = make_password(PASSWORD)
+        get_user_model().objects.bulk_create(
+            get_user_model()(username=self.next_username(), password=password) for _ in range(options['users']))
+        users = get_user_model().objects.filter(username__startswith=self.prefix).order_by('pk')
+        self.users = [(user.pk, user.username, AuthToken.objects.create(user=user)[1]) for user in users]
+        self.tokens = {user_id: token for user_id, _, token in self.users}
+
+        client = APIClient()
+        self.chats = []
+        for _ in range(options['chats']):
+            members = rng.sample(self.users, rng.randint(2, min(options['participants'], len(self.users))))
+            client.credentials(HTTP_AUTHORIZATION='Token ' + members[0][2])
+            response = client.post(reverse('create-chat'),
+                                   data={'invited': json.dumps([user_id for user_id, _, _ in members[1:]])})
+            if response.status_code != 201:
+                raise CommandError(f'Could not create a chat: {response.status_code} {response.content[:200]}')
+            self.chats.append((response.data['chat']['id'], [user_id for user_id, _, _ in members]))
+
+        for chat_id, members in self.chats:
+            for start in range(0, options['messages'], 500):
+                client.credentials(HTTP_AUTHORIZATION='Token ' + self.tokens[rng.choice(members)])
+                messages = [{'chat_id': chat_id, 'text': f'Message #{i}'}
+                            for i in range(start, min(start + 500, options['messages']))]
+                response = client.post(reverse('send-messages'), data={'messages': json.dumps(messages)})
+                if response.status_code != 201:
+                    raise CommandError(f'Could not send messages: {response.status_code} {response.content[:200]}')
+
+    def run(self, rng, options):
+        names = list(self.mix)
+        operations = iter(rng.choices(names, weights=[self.mix[name] for name in names], k=options['requests']))
+        operations_lock = threading.Lock()
+
+        def next_operation():
+            with operations_lock:
+                return next(operations, None)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(lambda index: self.send(index, next_operation),
+                                        range(options['concurrency'])))
+        duration = time.perf_counter() - started
+
+        samples = {name: [] for name in names}
+        for result in results:
+            for name, sample in result:
+                samples[name].append(sample)
+
+        endpoints = {}
+        for name, values in samples.items():
+            if not values:
+                continue
+            latencies = sorted(latency for latency, _, _ in values)
+            endpoints[name] = {
+                'requests': len(values),
+                'errors': sum(1 for _, _, status in values if status >= 400),
+                'throughput': round(len(values) / duration, 2),
+                'latency_ms': {
+                    'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+                    'p50': round(percentile(latencies, 50) * 1000, 2),
+                    'p90': round(percentile(latencies, 90) * 1000, 2),
+                    'p99': round(percentile(latencies, 99) * 1000, 2),
+                    'max': round(latencies[-1] * 1000, 2),
+                },
+                'queries_per_request': round(sum(queries for _, queries, _ in values) / len(values), 2),
+            }
+
+        return {
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'mix': self.mix,
+            'seed': self.seed,
+            'duration': round(duration, 3),
+            'throughput': round(options['requests'] / duration, 2),
+            'endpoints': endpoints,
+        }
+
+    def send(self, index, next_operation):
+        """Sends requests in the current thread until there are none left, returns `(name, sample)` pairs"""
+        rng = random.Random(f'{self.seed}-{index}')
+        # Failed requests are counted as errors like any other 5xx response
+        client = APIClient(raise_request_exception=False)
+        counter = QueryCounter()
+        results = []
+        try:
+            with ExitStack() as stack:
+                # Only the queries made in this thread are counted, not the ones made for it by other threads
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(counter))
+
+                name = next_operation()
+                while name is not None:
+                    method, url, data, token = self.OPERATIONS[name](self, rng)
+                    if token:
+                        client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+                    else:
+                        client.credentials()
+
+                    counter.queries = 0
+                    started = time.perf_counter()
+                    response = getattr(client, method)(url, data=data)
+                    results.append((name, (time.perf_counter() - started, counter.queries, response.status_code)))
+                    name = next_operation()
+        finally:
+            connections.close_all()
+        return results
+
+    def next_username(self):
+        return f'{self.prefix}{next(self.usernames)}'
+
+    def register(self, rng):
+        return 'post', reverse('register'), {'username': self.next_username(), 'password': PASSWORD}, None
+
+    def login(self, rng):
+        _, username, _ = rng.choice(self.users)
+        return 'post', reverse('login'), {'username': username, 'password': PASSWORD}, None
+
+    def create_chat(self, rng):
+        members = rng.sample(self.users, 2)
+        return 'post', reverse('create-chat'), {'invited': json.dumps([members[1][0]])}, members[0][2]
+
+    def send_message(self, rng):
+        chat_id, members = rng.choice(self.chats)
+        text = f'Load test message #{rng.randrange(10 ** 6)}'
+        return 'post', reverse('send-message', args=[chat_id]), {'text': text}, self.tokens[rng.choice(members)]
+
+    def chat_history(self, rng):
+        chat_id, members = rng.choice(self.chats)
+        return 'get', reverse('chat-history', args=[chat_id]), None, self.tokens[rng.choice(members)]
+
+    def chat_user(self, rng):
+        _, _, token = rng.choice(self.users)
+        return 'get', reverse('chat-user'), None, token
+
+    OPERATIONS = {
+        'register': register,
+        'login': login,
+        'create-chat': create_chat,
+        'send-message': send_message,
+        'chat-history': chat_history,
+        'chat-user': chat_user,
+    }
+
+    def clean_up(self):
+        user_ids = list(get_user_model().objects.filter(username__startswith=self.prefix).values_list('pk', flat=True))
+        scatter(lambda using: Chat.objects.using(using).filter(creator_id__in=user_ids).delete())
+        get_user_model().objects.filter(pk__in=user_ids).delete()
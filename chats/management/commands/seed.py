@@ -0,0 +1,212 @@
+import io
+import random
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from chats.models import Chat, ChatKey, Membership, Message
+from chats.sharding import is_sharded, shard_for
+
+
+# Pareto shape of the number of participants, most chats are dialogs and few are large groups
+PARTICIPANTS_SHAPE = 1.5
+WORDS = (
+    'hello', 'hi', 'thanks', 'ok', 'yes', 'no', 'maybe', 'today', 'tomorrow', 'meeting', 'call', 'later', 'sure',
+    'the', 'a', 'is', 'are', 'we', 'you', 'I', 'it', 'this', 'that', 'and', 'or', 'but', 'so', 'to', 'of', 'in',
+    'on', 'at', 'for', 'with', 'report', 'well', 'pump', 'pressure', 'data', 'check', 'send', 'see', 'done', 'soon',
+    'please', 'great', 'lunch', 'deadline', 'update', 'question',
+)
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Makes bulk_create keep the given `created_at` instead of stamping the time of the insert"""
+    fields = [model._meta.get_field('created_at') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def insert_returning_ids(queryset, objs):
+    """bulk_create that returns the ids of the new rows, also on databases that do not report them"""
+    if connections[queryset.db].features.can_return_rows_from_bulk_insert:
+        return [obj.pk for obj in queryset.bulk_create(objs)]
+    # The newest ids are the ones just inserted as long as nothing else writes to the table meanwhile
+    with transaction.atomic(using=queryset.db):
+        queryset.bulk_create(objs)
+        return sorted(queryset.order_by('-pk').values_list('pk', flat=True)[:len(objs)])
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def zipf_counts(total, n, exponent):
+    """`total` split over `n` ranks in proportion to 1 / rank ** exponent"""
+    weights = [rank ** -exponent for rank in range(1, n + 1)]
+    scale = total / sum(weights)
+    return [int(weight * scale) for weight in weights]
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with generated users, chats and messages. ' \
+           'The same seed generates the same data, dated back from the time of the run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--chats', type=int, default=20000)
+        parser.add_argument('--messages', type=int, default=1000000, help='Total number of messages, about')
+        parser.add_argument('--max-participants', type=int, default=100)
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='Exponent of the Zipf distribution of the messages over the chats')
+        parser.add_argument('--days', type=int, default=365, help='Number of days the messages are spread over')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='seed', help='Usernames are <prefix><number>')
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Number of rows inserted at once')
+        parser.add_argument('--no-copy', action='store_true', help='Uses bulk_create instead of COPY on PostgreSQL')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2 or options['max_participants'] < 2:
+            raise CommandError('Chats need at least two users')
+        if get_user_model().objects.filter(username=f'{options["prefix"]}0').exists():
+            raise CommandError(f'Users named {options["prefix"]}<number> exist already, choose another --prefix')
+
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.end = timezone.now()
+        self.start = self.end - timedelta(days=options['days'])
+
+        started = time.monotonic()
+        with explicit_timestamps(Chat, Message):
+            user_ids = self.create_users()
+            chats = self.create_chats(user_ids)
+            messages = self.create_messages(chats)
+        self.stdout.write(f'Created {len(user_ids)} users, {len(chats)} chats and {messages} messages '
+                          f'in {time.monotonic() - started:.1f} seconds')
+
+    def chunks(self, items):
+        size = self.options['chunk_size']
+        for start in range(0, len(items), size):
+            yield items[start:start + size]
+
+    def write_rows(self, using, model, fields, rows):
+        """Inserts rows of the given fields with COPY on PostgreSQL, or with bulk_create"""
+        connection = connections[using]
+        if connection.vendor != 'postgresql' or self.options['no_copy']:
+            model.objects.using(using).bulk_create((model(**dict(zip(fields, row))) for row in rows),
+                                                   batch_size=self.options['chunk_size'])
+            return
+
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(model._meta.get_field(field).column) for field in fields)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY {quote(model._meta.db_table)} ({columns}) FROM STDIN', buffer)
+
+    def create_users(self):
+        # Hashed once, every user gets the same salt and password
+        password = make_password(self.options['password'], salt=f'seed{self.options["seed"]}')
+        User = get_user_model()
+        names = [f'{self.options["prefix"]}{i}' for i in range(self.options['users'])]
+
+        user_ids = []
+        for chunk in self.chunks(names):
+            users = [User(username=name, password=password, date_joined=self.start) for name in chunk]
+            user_ids.extend(insert_returning_ids(User.objects.using(DEFAULT_DB_ALIAS), users))
+        return user_ids
+
+    def create_chats(self, user_ids):
+        """Returns `(chat_id, database, participant ids, created_at)` of the new chats"""
+        chats = []
+        span = (self.end - self.start).total_seconds()
+        for chunk in self.chunks(range(self.options['chats'])):
+            specs = []
+            for _ in chunk:
+                size = min(self.options['max_participants'], len(user_ids),
+                           int(2 * self.rng.paretovariate(PARTICIPANTS_SHAPE)))
+                # Chats are created in the first half of the period, so that all of them have some history
+                created_at = self.start + timedelta(seconds=self.rng.random() * span / 2)
+                specs.append((self.rng.sample(user_ids, size), created_at))
+
+            if is_sharded():
+                ids = insert_returning_ids(ChatKey.objects.using(DEFAULT_DB_ALIAS), [ChatKey() for _ in specs])
+                groups = {}
+                for chat_id, (members, created_at) in zip(ids, specs):
+                    groups.setdefault(shard_for(chat_id), []).append(
+                        Chat(pk=chat_id, creator_id=members[0], created_at=created_at))
+                for using, objs in groups.items():
+                    Chat.objects.using(using).bulk_create(objs)
+            else:
+                ids = insert_returning_ids(Chat.objects.using(DEFAULT_DB_ALIAS),
+                                           [Chat(creator_id=members[0], created_at=created_at)
+                                            for members, created_at in specs])
+
+            memberships = {}
+            for chat_id, (members, created_at) in zip(ids, specs):
+                using = shard_for(chat_id) or DEFAULT_DB_ALIAS
+                chats.append((chat_id, using, members, created_at))
+                memberships.setdefault(using, []).extend((chat_id, user_id, 0) for user_id in members)
+            for using, rows in memberships.items():
+                self.write_rows(using, Membership, ('chat_id', 'user_id', 'last_read_message_id'), rows)
+
+            if self.options['verbosity'] > 1:
+                self.stdout.write(f'{len(chats)} chats')
+        return chats
+
+    def create_messages(self, chats):
+        counts = zipf_counts(self.options['messages'], len(chats), self.options['zipf'])
+        # The busiest chats are picked at random rather than being the oldest ones
+        ranked = list(chats)
+        self.rng.shuffle(ranked)
+
+        fields = ('chat_id', 'author_id', 'text', 'created_at', 'seq')
+        buffers = {}
+        created = 0
+        for (chat_id, using, members, created_at), count in zip(ranked, counts):
+            if not count:
+                continue
+            # Evenly spread over the life of the chat with some jitter, so created_at follows seq
+            step = (self.end - created_at) / count
+            rows = buffers.setdefault(using, [])
+            for seq in range(1, count + 1):
+                text = ' '.join(self.rng.choices(WORDS, k=self.rng.randint(1, 20)))
+                rows.append((chat_id, self.rng.choice(members), text,
+                             created_at + step * (seq - 1 + self.rng.random()), seq))
+                if len(rows) >= self.options['chunk_size']:
+                    self.write_rows(using, Message, fields, rows)
+                    created += len(rows)
+                    rows.clear()
+                    if self.options['verbosity'] > 1:
+                        self.stdout.write(f'{created} messages')
+
+        for using, rows in buffers.items():
+            self.write_rows(using, Message, fields, rows)
+            created += len(rows)
+
+        updated = {}
+        for (chat_id, using, *_), count in zip(ranked, counts):
+            if count:
+                updated.setdefault(using, []).append(chat_id)
+        for using, chat_ids in updated.items():
+            for start in range(0, len(chat_ids), 500):
+                Chat.objects.using(using).filter(pk__in=chat_ids[start:start + 500]).update_last_message()
+        return created
@@ -0,0 +1,235 @@
+import os
+import random
+import resource
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.urls import get_resolver
+
+from oil_test.postgresql_pool.pool import close_pools
+
+
+def get_memory_usage():
+    """Peak resident memory of the process in megabytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / 1024 if sys.platform == 'darwin' else usage / 1024
+
+
+class RequestHandler(WSGIRequestHandler):
+    def setup(self):
+        # Idle or slow clients give their thread up after that many seconds without a byte
+        self.timeout = self.server.request_timeout
+        super().setup()
+
+    def handle(self):
+        try:
+            super().handle()
+        except socket.timeout:
+            # Expected of idle keep-alive connections, so they are closed without logging an error
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        if self.server.access_log:
+            super().log_message(format, *args)
+
+
+class WorkerServer(WSGIServer):
+    """
+    Serves the WSGI application on a listening socket shared with other processes, in up to `threads` threads.
+    It stops accepting connections after `max_requests` requests, or once the process took more than
+    `max_memory` megabytes, and `serve_forever` returns. `server_close` waits for the requests in progress
+    """
+
+    def __init__(self, sock, application, threads=8, max_requests=0, max_memory=0, request_timeout=None,
+                 access_log=False):
+        host, port = sock.getsockname()[:2]
+        super().__init__((host, port), RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(application)
+
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.request_timeout = request_timeout
+        self.access_log = access_log
+        self.slots = threading.BoundedSemaphore(threads)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='requests')
+        self.lock = threading.Lock()
+        self.handled = 0
+        self.stopping = False
+
+    def process_request(self, request, client_address):
+        # Waiting for a free thread here leaves the next connections to the other workers
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+            self.request_finished()
+
+    def request_finished(self):
+        with self.lock:
+            self.handled += 1
+            recycle = (self.max_requests and self.handled >= self.max_requests) \
+                or (self.max_memory and get_memory_usage() > self.max_memory)
+        if recycle:
+            self.stop()
+
+    def stop(self):
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        # shutdown() waits for serve_forever, which may be running in the calling thread (e.g. in a signal handler)
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class Command(BaseCommand):
+    help = 'Serves the WSGI application from several worker processes forked after it is loaded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='127.0.0.1:8000', help='Address to listen on as host:port')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes, one per CPU by default')
+        parser.add_argument('--threads', type=int, default=8, help='Number of requests a worker serves at once')
+        parser.add_argument('--max-requests', type=int, default=10000,
+                            help='A worker is replaced after about this many requests, 0 to keep it')
+        parser.add_argument('--max-memory', type=int, default=0,
+                            help='A worker is replaced once it took more megabytes of memory, 0 to keep it')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Seconds a connection may stay silent before it is closed')
+        parser.add_argument('--graceful-timeout', type=float, default=30,
+                            help='Seconds the requests in progress get to finish on shutdown')
+        parser.add_argument('--backlog', type=int, default=1024, help='Length of the queue of pending connections')
+        parser.add_argument('--access-log', action='store_true', help='Log every request to standard error')
+
+    def handle(self, *args, **options):
+        host, _, port = options['bind'].rpartition(':')
+        if not port.isdigit():
+            raise CommandError('--bind has to be host:port')
+        if options['workers'] < 1 or options['threads'] < 1:
+            raise CommandError('At least one worker and one thread are needed')
+        host = host.strip('[]') or '0.0.0.0'
+
+        try:
+            sock = socket.create_server((host, int(port)), family=socket.AF_INET6 if ':' in host else socket.AF_INET,
+                                        backlog=options['backlog'])
+        except OSError as e:
+            raise CommandError(f'Cannot listen on {options["bind"]}: {e}')
+        # Every worker waits for connections on this socket, the ones that lose the race to accept() move on
+        sock.setblocking(False)
+
+        # Loaded once here, the workers share the memory of the application until they write to it
+        from oil_test.wsgi import application
+        get_resolver().url_patterns
+        # Connections are not shared with the workers
+        connections.close_all()
+        close_pools()
+
+        self.options = options
+        self.workers = {}
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.stdout.write(f'Listening on {options["bind"]} with {options["workers"]} workers')
+        try:
+            while not self.stopping:
+                while len(self.workers) < options['workers'] and not self.stopping:
+                    self.spawn(sock, application)
+                time.sleep(0.1)
+                self.reap()
+        finally:
+            self.stop_workers()
+            sock.close()
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self, sock, application):
+        max_requests = self.options['max_requests']
+        # Workers started together should not be replaced all at once
+        max_requests += random.randint(0, max_requests // 10)
+
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return
+
+        status = 0
+        try:
+            server = WorkerServer(sock, application, threads=self.options['threads'], max_requests=max_requests,
+                                  max_memory=self.options['max_memory'], request_timeout=self.options['timeout'],
+                                  access_log=self.options['access_log'])
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                connections.close_all()
+                close_pools()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def reap(self):
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+
+            if os.WIFSIGNALED(status):
+                self.stderr.write(f'Worker {pid} was killed by signal {os.WTERMSIG(status)}')
+            elif os.WEXITSTATUS(status):
+                self.stderr.write(f'Worker {pid} exited with status {os.WEXITSTATUS(status)}')
+            elif self.options['verbosity'] > 1:
+                self.stdout.write(f'Worker {pid} was replaced after {time.monotonic() - started:.0f} seconds')
+
+    def stop_workers(self):
+        for pid in self.workers:
+            self.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.options['graceful_timeout']
+        while self.workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.reap()
+
+        for pid in self.workers:
+            self.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.clear()
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.6 on 2026-10-18 12:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+    ]
+
+    operations = [
+        # Create the composite index first, so that `chat_id` lookups are never left unindexed
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_at', 'id'], name='chats_message_history_idx'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='chat',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chats.chat'),
+        ),
+        # The auto-created participants table is only indexed for `chat_id -> user_id` lookups,
+        # listing the chats of a user needs the reverse direction
+        migrations.RunSQL(
+            sql='CREATE INDEX chats_chat_participants_user_chat_idx '
+                'ON chats_chat_participants (user_id, chat_id)',
+            reverse_sql='DROP INDEX chats_chat_participants_user_chat_idx',
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.1.6 on 2026-10-18 12:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chats', '0002_history_indexes'),
+    ]
+
+    operations = [
+        # The auto-created participants table becomes the explicit `Membership` model,
+        # the table and its rows are kept as they are
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Membership',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chats.chat')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'chats_chat_participants',
+                        'unique_together': {('chat', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='chat',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='chats', through='chats.Membership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        # Index names are limited to 30 characters once the table belongs to a model
+        migrations.RunSQL(
+            sql='DROP INDEX chats_chat_participants_user_chat_idx',
+            reverse_sql='CREATE INDEX chats_chat_participants_user_chat_idx '
+                        'ON chats_chat_participants (user_id, chat_id)',
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(fields=['user', 'chat'], name='chats_member_user_chat_idx'),
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='last_read_message_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Existing history counts as read, and the last messages are filled in for existing chats
+        migrations.RunSQL(
+            sql=[
+                'UPDATE chats_chat_participants SET last_read_message_id = COALESCE('
+                '(SELECT MAX(id) FROM chats_message WHERE chats_message.chat_id = chats_chat_participants.chat_id), 0)',
+                'UPDATE chats_chat SET last_message_id = '
+                '(SELECT MAX(id) FROM chats_message WHERE chats_message.chat_id = chats_chat.id)',
+                'UPDATE chats_chat SET last_message_at = '
+                '(SELECT created_at FROM chats_message WHERE chats_message.id = chats_chat.last_message_id)',
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
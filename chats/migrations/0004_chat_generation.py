@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
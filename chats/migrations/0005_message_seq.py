@@ -0,0 +1,44 @@
+# Generated by Django 3.1.6 on 2026-10-18 12:58
+
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    # Existing messages are numbered in the order of the history
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'UPDATE chats_message SET seq = numbered.seq FROM ('
+            'SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY created_at, id) AS seq FROM chats_message'
+            ') numbered WHERE chats_message.id = numbered.id'
+        )
+    else:
+        schema_editor.execute(
+            'UPDATE chats_message SET seq = (SELECT COUNT(*) FROM chats_message earlier '
+            'WHERE earlier.chat_id = chats_message.chat_id AND (earlier.created_at < chats_message.created_at '
+            'OR (earlier.created_at = chats_message.created_at AND earlier.id <= chats_message.id)))'
+        )
+    schema_editor.execute(
+        'UPDATE chats_chat SET last_seq = COALESCE('
+        '(SELECT MAX(seq) FROM chats_message WHERE chats_message.chat_id = chats_chat.id), 0)'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_chat_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+    ]
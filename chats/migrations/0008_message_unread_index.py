@@ -0,0 +1,17 @@
+# Generated by Django 3.1.6 on 2026-10-18 13:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_chat_shards'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'id'], name='chats_message_unread_idx'),
+        ),
+    ]
@@ -1,21 +1,267 @@
+import operator
+from functools import reduce
+
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Count, Exists, F, IntegerField, Max, OuterRef, Q, Subquery, Value, When, Window
+from django.db.models.functions import Coalesce, Greatest, RowNumber
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+
+class ChatQuerySet(models.QuerySet):
+
+    def with_participant(self, user):
+        memberships = Membership.objects.filter(chat_id=OuterRef('pk'), user_id=user.pk)
+        return self.filter(Exists(memberships))
+
+    def has_participant(self, chat_id, user):
+        """Checks that the chat exists and the user takes part in it, in a single query"""
+        return self.with_participant(user).filter(pk=chat_id).exists()
+
+    def history_version(self, chat_id, user):
+        """
+        `(generation, last_message_id)` of the chat if the user takes part in it, None otherwise.
+        The generation changes along with any message of the chat, see `Chat.generation`
+        """
+        return next(iter(self.history_version_query(chat_id, user)), None)
+
+    def history_version_query(self, chat_id, user):
+        return self.with_participant(user).filter(pk=chat_id).values_list('generation', 'last_message_id')[:1]
+
+    def list_version(self, user):
+        """
+        Version of the list of chats of the user. Memberships are only added along with new chats,
+        so the number of them and the newest chat identify the list, both read from the `(user, chat)` index
+        """
+        count, last_chat_id = next(iter(self.list_version_query(user)), (0, None))
+        return f'{count}.{last_chat_id}'
+
+    def list_version_query(self, user):
+        return Membership.objects.using(self._db).filter(user_id=user.pk).order_by().values('user_id') \
+                                 .annotate(count=Count('chat_id'), last_chat_id=Max('chat_id')) \
+                                 .values_list('count', 'last_chat_id')
+
+    def inbox(self, user):
+        """Chats of the user by last activity, with the last message and the number of unread ones"""
+        unread = Message.objects.filter(chat_id=OuterRef('pk'), id__gt=OuterRef('last_read_message_id')) \
+                                .order_by().values('chat_id').annotate(count=Count('*')).values('count')
+        return self.filter(memberships__user_id=user.pk) \
+                   .annotate(last_read_message_id=F('memberships__last_read_message_id')) \
+                   .annotate(unread_count=Coalesce(Subquery(unread), Value(0)),
+                             last_activity=Coalesce('last_message_at', 'created_at'))
+
+    def update_last_message(self):
+        latest = Message.objects.filter(chat_id=OuterRef('pk')).order_by('-created_at', '-id')
+        return self.update(last_message_id=Subquery(latest.values('id')[:1]),
+                           last_message_at=Subquery(latest.values('created_at')[:1]),
+                           last_seq=Coalesce(Subquery(Message.objects.filter(chat_id=OuterRef('pk'))
+                                                                     .order_by('-seq').values('seq')[:1]), 0),
+                           generation=F('generation') + 1)
+
+    def lock_last_seq(self, chat_ids):
+        """
+        Locks the chats until the end of the transaction and returns their last sequence numbers.
+        Chats are locked in the order of their ids, so that concurrent batches cannot deadlock
+        """
+        return dict(self.select_for_update().filter(pk__in=chat_ids).order_by('pk').values_list('pk', 'last_seq'))
+
+    def add_message(self, message):
+        """
+        Bumps the generation and the sequence number of the chat of a message that was just created
+        in the current transaction. The last message is only replaced by a newer one
+        """
+        newer = Q(last_message__isnull=True) | Q(last_message_id__lt=message.pk)
+        return self.filter(pk=message.chat_id).update(
+            last_seq=Greatest(F('last_seq'), Value(message.seq)),
+            last_message_id=Case(When(newer, then=Value(message.pk)), default=F('last_message_id'),
+                                 output_field=IntegerField()),
+            last_message_at=Case(When(newer, then=Value(message.created_at)), default=F('last_message_at'),
+                                 output_field=models.DateTimeField()),
+            generation=F('generation') + 1,
+        )
 
 
 class Chat(models.Model):
-    participants = models.ManyToManyField(get_user_model(), related_name='chats')
-    creator = models.ForeignKey(get_user_model(), related_name='created_chats', on_delete=models.CASCADE)
+    participants = models.ManyToManyField(get_user_model(), related_name='chats', through='Membership')
+    # Users stay on the global database when chats are sharded, so their keys cannot be constrained
+    creator = models.ForeignKey(get_user_model(), related_name='created_chats', on_delete=models.CASCADE,
+                                db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized from the messages so that the inbox does not have to look them up
+    last_message = models.ForeignKey('Message', related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_seq = models.PositiveIntegerField(default=0)
+    # Incremented whenever a message of the chat is created, changed or deleted.
+    # The row stays locked until commit, so concurrent writers see consecutive generations
+    generation = models.PositiveIntegerField(default=0)
+
+    objects = ChatQuerySet.as_manager()
 
     def __str__(self):
         return f'Chat: #{self.pk} created by {self.creator}'
 
 
+class ChatKey(models.Model):
+    """Hands out the ids of new chats on the global database once chats are sharded, see `chats.sharding`"""
+
+
+class Membership(models.Model):
+    chat = models.ForeignKey(Chat, related_name='memberships', on_delete=models.CASCADE)
+    user = models.ForeignKey(get_user_model(), related_name='memberships', on_delete=models.CASCADE,
+                             db_constraint=False)
+    # Messages with a greater id are unread by the user
+    last_read_message_id = models.IntegerField(default=0)
+
+    class Meta:
+        # Keeps the table of the auto-created many-to-many relation it replaced
+        db_table = 'chats_chat_participants'
+        unique_together = [('chat', 'user')]
+        indexes = [
+            models.Index(fields=['user', 'chat'], name='chats_member_user_chat_idx'),
+        ]
+
+    def __str__(self):
+        return f'Membership: {self.user} | Chat: #{self.chat_id}'
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def delete(self):
+        """Deletes the messages and bumps the generation of each of their chats once, see `Chat.generation`"""
+        with transaction.atomic(using=self.db):
+            chat_ids = set(self.order_by().values_list('chat_id', flat=True).distinct())
+            deleted = super().delete()
+            Chat.objects.using(self.db).filter(pk__in=chat_ids).update(generation=F('generation') + 1)
+        return deleted
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class MessageManager(models.Manager.from_queryset(MessageQuerySet)):
+
+    def bulk_send(self, messages):
+        """
+        Inserts messages of any authors into any number of chats within a single transaction.
+        Messages of chats that no longer exist are left out and keep no id, the sent ones are returned
+        """
+        with transaction.atomic(using=self.db):
+            last_seq = Chat.objects.using(self.db).lock_last_seq({message.chat_id for message in messages})
+            messages = [message for message in messages if int(message.chat_id) in last_seq]
+            for message in messages:
+                chat_id = int(message.chat_id)
+                last_seq[chat_id] += 1
+                message.seq = last_seq[chat_id]
+
+            if connections[self.db].features.can_return_rows_from_bulk_insert:
+                self.bulk_create(messages)
+            else:
+                # The ids are needed in the response and cannot be read back after a bulk insert here
+                for message in messages:
+                    message.save(using=self.db)
+
+            last_sent = {}
+            for message in messages:
+                key = (message.chat_id, message.author_id)
+                last_sent[key] = max(last_sent.get(key, 0), message.pk)
+            if last_sent:
+                Chat.objects.using(self.db).filter(pk__in={chat_id for chat_id, _ in last_sent}).update_last_message()
+                senders = [Q(chat_id=chat_id, user_id=author_id) for chat_id, author_id in last_sent]
+                last_read = Case(*[When(sender, then=Value(pk)) for sender, pk in zip(senders, last_sent.values())],
+                                 output_field=IntegerField())
+                Membership.objects.using(self.db).filter(reduce(operator.or_, senders)) \
+                                  .update(last_read_message_id=Greatest(F('last_read_message_id'), last_read))
+        return messages
+
+    def latest_per_chat(self, user, count):
+        """Returns the `count` newest messages of every chat of the user in a single query"""
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            sql, params = self._latest_per_chat_lateral(connection, user, count)
+        else:
+            sql, params = self._latest_per_chat_window(connection, user, count)
+        return self.raw(sql, params)
+
+    def _latest_per_chat_lateral(self, connection, user, count):
+        # Every chat reads at most `count` rows from the `(chat, created_at, id)` index
+        qn = connection.ops.quote_name
+        columns = ', '.join(f'm.{qn(field.column)}' for field in self.model._meta.concrete_fields)
+        sql = (
+            f'SELECT {columns} FROM {qn(Membership._meta.db_table)} p '
+            f'CROSS JOIN LATERAL ('
+            f'SELECT * FROM {qn(self.model._meta.db_table)} '
+            f'WHERE {qn("chat_id")} = p.{qn("chat_id")} '
+            f'ORDER BY {qn("created_at")} DESC, {qn("id")} DESC LIMIT %s'
+            f') m WHERE p.{qn("user_id")} = %s '
+            f'ORDER BY m.{qn("chat_id")}, m.{qn("created_at")}, m.{qn("id")}'
+        )
+        return sql, (count, user.pk)
+
+    def _latest_per_chat_window(self, connection, user, count):
+        chats = Membership.objects.filter(user_id=user.pk).values('chat_id')
+        ranked = self.filter(chat_id__in=chats).annotate(rank=Window(
+            expression=RowNumber(),
+            partition_by=[F('chat_id')],
+            order_by=[F('created_at').desc(), F('id').desc()],
+        ))
+        inner, params = ranked.query.sql_with_params()
+        qn = connection.ops.quote_name
+        sql = (
+            f'SELECT * FROM ({inner}) ranked WHERE ranked.{qn("rank")} <= %s '
+            f'ORDER BY ranked.{qn("chat_id")}, ranked.{qn("created_at")}, ranked.{qn("id")}'
+        )
+        return sql, (*params, count)
+
+
 class Message(models.Model):
-    chat = models.ForeignKey(Chat, related_name='messages', on_delete=models.CASCADE)
-    author = models.ForeignKey(get_user_model(), related_name='messages', on_delete=models.CASCADE)
+    # The composite index below starts with `chat`, so a separate FK index is redundant
+    chat = models.ForeignKey(Chat, related_name='messages', on_delete=models.CASCADE, db_index=False)
+    author = models.ForeignKey(get_user_model(), related_name='messages', on_delete=models.CASCADE,
+                               db_constraint=False)
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Numbers the messages of every chat from 1 without gaps, in the order they are committed
+    seq = models.PositiveIntegerField()
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'created_at', 'id'], name='chats_message_history_idx'),
+            # Unread messages are counted by id, past the read marker of the member
+            models.Index(fields=['chat', 'id'], name='chats_message_unread_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'seq'], name='chats_message_chat_seq_uniq'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding or self.seq is not None:
+            return super().save(*args, **kwargs)
+
+        # The chat stays locked until commit, so its messages are numbered in the order they are committed
+        using = kwargs.get('using') or router.db_for_write(Message, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            self.seq = Chat.objects.using(using).lock_last_seq([self.chat_id])[int(self.chat_id)] + 1
+            super().save(*args, **kwargs)
+            Chat.objects.using(using).add_message(self)
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(Message, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            deleted = super().delete(*args, **kwargs)
+            Chat.objects.using(using).filter(pk=self.chat_id).update(generation=F('generation') + 1)
+        return deleted
 
     def __str__(self):
-        return f'Message: #{self.pk} | Author: {self.author} | Chat: {self.chat}'
\ No newline at end of file
+        return f'Message: #{self.pk} | Author: {self.author} | Chat: {self.chat}'
+
+
+@receiver(post_save, sender=Message)
+def bump_chat_generation(sender, instance, created=False, raw=False, **kwargs):
+    # Sends bump the generation themselves, this covers edits made elsewhere, e.g. in the admin.
+    # Deletes bump it in `Message.delete()` and `MessageQuerySet.delete()`, once per chat, while messages
+    # deleted along with their chat leave it alone. Bulk `update()` calls have to bump it on their own
+    if not created and not raw:
+        Chat.objects.using(instance._state.db).filter(pk=instance.chat_id).update(generation=F('generation') + 1)
@@ -0,0 +1,164 @@
+import base64
+import binascii
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination over `(created_at, id)`.
+
+    Without a cursor the newest page is returned. `before` walks towards older
+    messages and `after` towards newer ones. Every page is a bounded index range
+    scan, so its cost does not grow with the depth of the history the way OFFSET does.
+    Messages inside a page are always in chronological order.
+
+    `after_seq` pages through the messages that follow a known sequence number of the chat instead,
+    in the order of their sequence numbers, which lets clients fill a gap they detected exactly.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    after_seq_query_param = 'after_seq'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.read_request(request)
+        return self.paginate_rows(list(self.page_queryset(queryset)))
+
+    def page_queryset(self, queryset):
+        """The messages of the page that `read_request` asked for, with one more to tell whether others follow"""
+        if self.after_seq is not None:
+            queryset = queryset.filter(seq__gt=self.after_seq).order_by('seq')
+        elif self.after is not None:
+            queryset = queryset.filter(self.newer_than(self.after)).order_by('created_at', 'id')
+        else:
+            if self.before is not None:
+                queryset = queryset.filter(self.older_than(self.before))
+            queryset = queryset.order_by('-created_at', '-id')
+        return queryset[:self.page_size + 1]
+
+    def read_request(self, request):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        self.after = self.decode_cursor(request.query_params.get(self.after_query_param))
+        self.after_seq = self.decode_seq(request.query_params.get(self.after_seq_query_param))
+
+        if sum(cursor is not None for cursor in (self.before, self.after, self.after_seq)) > 1:
+            raise ValidationError('Only one of `before`, `after` and `after_seq` can be used at once')
+
+    @property
+    def ascending(self):
+        return self.after is not None or self.after_seq is not None
+
+    def paginate_rows(self, page):
+        """
+        Paginates messages fetched by the caller: up to `page_size + 1` of them going away from the cursor,
+        i.e. oldest first after one and newest first otherwise
+        """
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+
+        if self.ascending:
+            self.has_next, self.has_previous = has_more, bool(page)
+        else:
+            page.reverse()
+            self.has_next, self.has_previous = self.before is not None and bool(page), has_more
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('previous', self.get_previous_link()),
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.after_query_param)
+        url = remove_query_param(url, self.after_seq_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[0]))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.before_query_param)
+        if self.after_seq is not None:
+            last = self.page[-1]
+            seq = last['seq'] if isinstance(last, dict) else last.seq
+            return replace_query_param(url, self.after_seq_query_param, seq)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[-1]))
+
+    # The leading inclusive bound lets the database seek into the `(chat, created_at, id)`
+    # index instead of filtering the whole chat
+    @staticmethod
+    def older_than(position):
+        created_at, pk = position
+        return Q(created_at__lte=created_at) & (Q(created_at__lt=created_at) | Q(id__lt=pk))
+
+    @staticmethod
+    def newer_than(position):
+        created_at, pk = position
+        return Q(created_at__gte=created_at) & (Q(created_at__gt=created_at) | Q(id__gt=pk))
+
+    @staticmethod
+    def encode_cursor(message):
+        # Pages are made either of messages or of their `values()` rows
+        if isinstance(message, dict):
+            created_at, pk = message['created_at'], message['id']
+        else:
+            created_at, pk = message.created_at, message.pk
+        raw = f'{created_at.isoformat()}|{pk}'
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_seq(self, encoded):
+        if encoded is None:
+            return None
+        try:
+            seq = int(encoded)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if seq < 0:
+            raise NotFound(self.invalid_cursor_message)
+        return seq
+
+    def decode_cursor(self, encoded):
+        if encoded is None:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            created_at, pk = raw.split('|')
+            created_at, pk = parse_datetime(created_at), int(pk)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+
+class ChatInboxPagination(CursorPagination):
+    ordering = ('-last_activity', '-id')
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class BaseBroker:
+    """
+    Publish/subscribe layer used to fan out new messages to connected clients.
+
+    `publish` may be called from any thread. Subscriptions are consumed
+    from the event loop they were created in, listeners block the calling thread.
+    """
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        raise NotImplementedError
+
+    def listen(self, channels):
+        raise NotImplementedError
+
+
+class InProcessSubscription:
+
+    def __init__(self, broker, channel, maxsize):
+        self.broker = broker
+        self.channels = (channel, )
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def deliver(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The event loop of the subscriber is gone
+            self.close()
+
+    def _put(self, message):
+        # A slow client loses its oldest messages instead of growing the queue without bound
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessListener:
+    """Wakes up a waiting thread once something is published to any of its channels"""
+
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = tuple(channels)
+        self.event = threading.Event()
+
+    def deliver(self, message):
+        self.event.set()
+
+    def wait(self, timeout):
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return woken
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InProcessBroker(BaseBroker):
+    """Delivers messages to the subscribers of the current process only, no broker is required"""
+    subscription_class = InProcessSubscription
+    listener_class = InProcessListener
+    queue_size = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+    def subscribe(self, channel):
+        return self.register(self.subscription_class(self, channel, self.queue_size))
+
+    def listen(self, channels):
+        return self.register(self.listener_class(self, channels))
+
+    def register(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscriptions = self.subscriptions.get(channel)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self.subscriptions[channel]
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(settings.CHATS_PUBSUB_BROKER)()
+
+
+def chat_channel(chat_id):
+    return f'chat.{chat_id}'
@@ -0,0 +1,65 @@
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Renders the same bytes as `JSONRenderer`, as long as the data is made of plain
+    dicts, lists, strings, integers and None only, like `chats.representations` produce.
+    orjson is used when it is installed. Pretty printed output is left to `JSONRenderer`.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if orjson is not None:
+            ret = orjson.dumps(data)
+        else:
+            ret = json.dumps(data, ensure_ascii=False, allow_nan=not self.strict, separators=(',', ':')).encode()
+
+        # `JSONRenderer` escapes these to keep the output a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class CompactJSONRenderer(FastJSONRenderer):
+    """Selects the compact chat history, see `represent_messages_compact`"""
+    media_type = 'application/vnd.chats.compact+json'
+    format = 'compact'
+    compact_messages = True
+
+
+class MessagePackRenderer(BaseRenderer):
+    """The compact chat history encoded with MessagePack, available when msgpack is installed"""
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    compact_messages = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True)
+
+
+def get_history_renderers():
+    history_renderers = [FastJSONRenderer, CompactJSONRenderer]
+    if msgpack is not None:
+        history_renderers.append(MessagePackRenderer)
+    return history_renderers
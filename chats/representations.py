@@ -0,0 +1,74 @@
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from django.utils import timezone
+
+# Plain `values()` counterparts of `MessagePreviewSerializer` and `ChatPreviewSerializer`.
+# DRF builds and runs field objects for every row, which dominates the time spent on long lists,
+# these produce the same output straight from the database rows.
+MESSAGE_VALUES = ('id', 'seq', 'author_id', 'author__username', 'text', 'created_at')
+CHAT_PREVIEW_VALUES = ('id', 'creator_id', 'creator__username', 'created_at')
+
+
+def get_datetime_formatter():
+    if api_settings.DATETIME_FORMAT is None or api_settings.DATETIME_FORMAT.lower() != ISO_8601:
+        return serializers.DateTimeField().to_representation
+
+    tz = timezone.get_current_timezone()
+
+    def format_datetime(value):
+        if value is None:
+            return None
+        value = value.astimezone(tz).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    return format_datetime
+
+
+def represent_message(row, format_datetime):
+    return {
+        'id': row['id'],
+        'seq': row['seq'],
+        'author': {'id': row['author_id'], 'username': row['author__username']},
+        'text': row['text'],
+        'created_at': format_datetime(row['created_at']),
+    }
+
+
+def represent_messages(rows):
+    format_datetime = get_datetime_formatter()
+    return [represent_message(row, format_datetime) for row in rows]
+
+
+def represent_chats(rows):
+    format_datetime = get_datetime_formatter()
+    return [{
+        'id': row['id'],
+        'creator': {'id': row['creator_id'], 'username': row['creator__username']},
+        'created_at': format_datetime(row['created_at']),
+    } for row in rows]
+
+
+def represent_messages_compact(rows):
+    """
+    Same messages as `represent_messages`, with every author listed once
+    and the messages laid out as columns that refer to the authors by id
+    """
+    format_datetime = get_datetime_formatter()
+    authors = {}
+    ids, seqs, author_ids, texts, created_at = [], [], [], [], []
+    for row in rows:
+        author_id = row['author_id']
+        if author_id not in authors:
+            authors[author_id] = row['author__username']
+        ids.append(row['id'])
+        seqs.append(row['seq'])
+        author_ids.append(author_id)
+        texts.append(row['text'])
+        created_at.append(format_datetime(row['created_at']))
+
+    return {
+        'authors': [{'id': author_id, 'username': username} for author_id, username in authors.items()],
+        'messages': {'id': ids, 'seq': seqs, 'author': author_ids, 'text': texts, 'created_at': created_at},
+    }
@@ -1,20 +1,30 @@
 import json
 
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from accounts.serializers import UserSerializer
 
-from chats.models import Chat, Message
+from chats.cache import message_row, tail_cache
+from chats.ingest import get_message_committer
+from chats.models import Chat, Membership, Message
+from chats.sharding import allocate_chat_id, group_by_shard, shard_for
 
 
 class ChatSerializer(serializers.ModelSerializer):
-    participants = UserSerializer(read_only=True, many=True)
+    participants = serializers.SerializerMethodField()
     creator = UserSerializer(read_only=True)
 
     class Meta:
         model = Chat
-        fields = '__all__'
+        fields = ('id', 'participants', 'creator', 'created_at')
+
+    def get_participants(self, chat):
+        # Memberships are on the shard of the chat and users may be on another database, so they are not joined
+        user_ids = list(chat.memberships.values_list('user_id', flat=True))
+        users = get_user_model().objects.filter(pk__in=user_ids).order_by('pk')
+        return UserSerializer(users, many=True, context=self.context).data
 
     def create(self, validated_data):
         creator = validated_data.get('creator')
@@ -29,20 +39,23 @@ class ChatSerializer(serializers.ModelSerializer):
         if not isinstance(invited_pks, list):
             raise serializers.ValidationError('`invited` parameter is a list of integers')
 
-        invited_users = [creator, ]
-        try:
-            for pk in invited_pks:
-                if not isinstance(pk, int):
-                    raise serializers.ValidationError('An entry of the invited list should be an integer')
-                if pk == creator.pk:
-                    raise serializers.ValidationError('You cannot invite yourself to a chat')
-                invited_users.append(get_user_model().objects.get(pk=pk))
-        except ObjectDoesNotExist:
+        for pk in invited_pks:
+            if not isinstance(pk, int):
+                raise serializers.ValidationError('An entry of the invited list should be an integer')
+            if pk == creator.pk:
+                raise serializers.ValidationError('You cannot invite yourself to a chat')
+
+        invited_pks = list(dict.fromkeys(invited_pks))
+        if invited_pks and get_user_model().objects.filter(pk__in=invited_pks).count() != len(invited_pks):
             raise serializers.ValidationError('One or more invited users are not registered yet')
 
-        chat = Chat.objects.create(creator=creator)
-        chat.participants.set(invited_users)
-        chat.save()
+        pk = allocate_chat_id()
+        using = shard_for(pk)
+        with transaction.atomic(using=using):
+            chat = Chat.objects.using(using).create(pk=pk, creator=creator)
+            Membership.objects.using(using).bulk_create([
+                Membership(chat_id=chat.pk, user_id=pk) for pk in [creator.pk, *invited_pks]
+            ])
 
         return chat
 
@@ -60,29 +73,105 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ('id', 'author', 'text', 'created_at')
+        fields = ('id', 'seq', 'author', 'text', 'created_at')
+        read_only_fields = ('seq', )
 
     def create(self, validated_data):
         chat_id = validated_data.get('chat_id')
         author = validated_data.get('author')
         text = validated_data.get('text')
 
-        try:
-            chat = Chat.objects.get(pk=chat_id)
-        except ObjectDoesNotExist:
+        using = shard_for(chat_id)
+        if not Chat.objects.using(using).has_participant(chat_id, author):
             raise serializers.ValidationError('Chat does not exist')
 
-        if author not in chat.participants.all():
-            raise serializers.ValidationError('Chat does not exist')
-
-        message = Message.objects.create(chat=chat, author=author, text=text)
+        # Rows of other requests cannot be committed as a part of a transaction that is already open
+        if getattr(settings, 'CHATS_GROUP_COMMIT', False) and not transaction.get_connection(using).in_atomic_block:
+            message = get_message_committer(using).submit(Message(chat_id=chat_id, author=author, text=text))
+            # The chat was deleted since it was checked
+            if message.pk is None:
+                raise serializers.ValidationError('Chat does not exist')
+            return message
+
+        with transaction.atomic(using=using):
+            message = Message.objects.using(using).create(chat_id=chat_id, author=author, text=text)
+            Membership.objects.using(using) \
+                              .filter(chat_id=chat_id, user_id=author.pk, last_read_message_id__lt=message.pk) \
+                              .update(last_read_message_id=message.pk)
+
+            # Only chats with a cached tail pay for reading the generation back
+            if chat_id in tail_cache:
+                generation = Chat.objects.using(using).filter(pk=chat_id) \
+                                         .values_list('generation', flat=True).get()
+                transaction.on_commit(lambda: tail_cache.add(chat_id, generation, [message_row(message)]))
 
         return message
 
 
+class MessageBatchSerializer(serializers.Serializer):
+    max_messages = 500
+
+    def create(self, validated_data):
+        author = validated_data.get('author')
+        items = validated_data.get('messages')
+
+        if isinstance(items, str):
+            try:
+                items = json.loads(items)
+            except json.JSONDecodeError:
+                raise serializers.ValidationError('`messages` parameter is a json-like list of objects')
+        if items is None:
+            raise serializers.ValidationError('`messages` parameter should not be missing')
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise serializers.ValidationError('`messages` parameter is a list of objects')
+        if len(items) > self.max_messages:
+            raise serializers.ValidationError(f'No more than {self.max_messages} messages can be sent at once')
+
+        chat_ids = {item.get('chat_id') for item in items if isinstance(item.get('chat_id'), int)}
+        allowed_chat_ids = set()
+        for using, shard_chat_ids in group_by_shard(chat_ids).items():
+            allowed_chat_ids.update(Chat.objects.using(using).with_participant(author).filter(pk__in=shard_chat_ids)
+                                                .values_list('pk', flat=True))
+
+        results, messages = [], []
+        for item in items:
+            chat_id, text = item.get('chat_id'), item.get('text')
+            if chat_id not in allowed_chat_ids:
+                results.append('Chat does not exist')
+            elif not isinstance(text, str) or not text.strip():
+                results.append('Message text should be a non-empty string')
+            else:
+                message = Message(chat_id=chat_id, author=author, text=text)
+                messages.append(message)
+                results.append(message)
+
+        # A transaction cannot span several shards, so a batch is committed shard by shard
+        for using, shard_messages in group_by_shard(messages, lambda message: message.chat_id).items():
+            Message.objects.db_manager(using).bulk_send(shard_messages)
+
+        # Chats deleted since they were checked
+        return [result if isinstance(result, str) or result.pk is not None else 'Chat does not exist'
+                for result in results]
+
+
 class MessagePreviewSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
 
     class Meta:
         model = Message
-        fields = ('id', 'author', 'text', 'created_at')
+        fields = ('id', 'seq', 'author', 'text', 'created_at')
+
+
+class ChatBootstrapSerializer(ChatPreviewSerializer):
+    messages = MessagePreviewSerializer(source='latest_messages', many=True, read_only=True)
+
+    class Meta(ChatPreviewSerializer.Meta):
+        fields = ChatPreviewSerializer.Meta.fields + ('messages', )
+
+
+class ChatInboxSerializer(ChatPreviewSerializer):
+    last_message = MessagePreviewSerializer(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
+
+    class Meta(ChatPreviewSerializer.Meta):
+        fields = ChatPreviewSerializer.Meta.fields + ('last_message', 'last_message_at', 'unread_count')
@@ -0,0 +1,197 @@
+import heapq
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+
+from chats.models import ChatKey
+
+
+# Every row of these models belongs to a single chat and lives on the shard of that chat
+SHARDED_MODELS = {'chats.chat', 'chats.membership', 'chats.message'}
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_shards():
+    return getattr(settings, 'CHATS_SHARDS', None) or [DEFAULT_DB_ALIAS]
+
+
+def is_sharded():
+    return get_shards() != [DEFAULT_DB_ALIAS]
+
+
+def shard_for(chat_id):
+    """
+    The database alias of the shard that holds the chat. Without sharding it is None,
+    which leaves the choice to the routers like for any other query
+    """
+    if not is_sharded():
+        return None
+    shards = get_shards()
+    return shards[zlib.crc32(str(int(chat_id)).encode('ascii')) % len(shards)]
+
+
+def group_by_shard(items, chat_id=lambda item: item):
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_for(chat_id(item)), []).append(item)
+    return groups
+
+
+def allocate_chat_id():
+    """
+    Ids of new chats are handed out by the global database once chats are sharded, so that they are unique
+    across the shards and known before the shard is picked. Otherwise the chat table picks them itself
+    """
+    if not is_sharded():
+        return None
+    return ChatKey.objects.using(DEFAULT_DB_ALIAS).create().pk
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=getattr(settings, 'CHATS_SHARD_WORKERS', 16),
+                                          thread_name_prefix='shards')
+        return executor
+
+
+def run_on_shard(func, using):
+    close_old_connections()
+    try:
+        return func(using)
+    finally:
+        close_old_connections()
+
+
+def scatter(func):
+    """Calls `func(using)` for every shard at once and returns the results in the order of the shards"""
+    if not is_sharded():
+        return [func(None)]
+    futures = [get_executor().submit(run_on_shard, func, using) for using in get_shards()]
+    return [future.result() for future in futures]
+
+
+class MergedQuerySet:
+    """
+    A queryset that runs on every shard, with the part of the QuerySet API that iterating,
+    slicing and cursor pagination need. The rows of the shards are merged in the order of the queryset,
+    whose fields all have to be sorted in the same direction
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    def filter(self, *args, **kwargs):
+        return MergedQuerySet(self.queryset.filter(*args, **kwargs))
+
+    def order_by(self, *fields):
+        return MergedQuerySet(self.queryset.order_by(*fields))
+
+    def __iter__(self):
+        return iter(self.fetch(None))
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice) or k.step is not None:
+            raise TypeError('Only slices without a step are supported')
+        return self.fetch(k.stop)[k.start:k.stop]
+
+    def fetch(self, limit):
+        results = scatter(lambda using: list(self.queryset.using(using)[:limit]))
+        if len(results) == 1:
+            return results[0]
+
+        ordering = self.queryset.query.order_by
+        if not ordering:
+            return list(chain(*results))
+        if len({field.startswith('-') for field in ordering}) > 1:
+            raise ValueError('Merged querysets have to be ordered in one direction')
+
+        pk = self.queryset.model._meta.pk.attname
+        names = [field.lstrip('-') for field in ordering]
+
+        def key(row):
+            if isinstance(row, dict):
+                return tuple(row[pk if name == 'pk' else name] for name in names)
+            return tuple(getattr(row, name) for name in names)
+
+        return list(heapq.merge(*results, key=key, reverse=ordering[0].startswith('-')))
+
+
+def on_all_shards(queryset):
+    """The queryset itself without sharding, or merged over all the shards"""
+    if not is_sharded():
+        return queryset
+    return MergedQuerySet(queryset)
+
+
+def join_users(queryset, *fields):
+    """Joins related users in, or looks them up separately once chats are sharded away from the users"""
+    if is_sharded():
+        return queryset.prefetch_related(*fields)
+    return queryset.select_related(*fields)
+
+
+def shard_values(fields):
+    """The `values()` fields that can be read where the chats are, `add_usernames` fills the usernames in"""
+    if not is_sharded():
+        return fields
+    return tuple(field for field in fields if not field.endswith('__username'))
+
+
+def add_usernames(rows, relation):
+    """Fills `<relation>__username` in the rows read with `shard_values()`"""
+    if not is_sharded() or not rows:
+        return rows
+    user_ids = {row[f'{relation}_id'] for row in rows}
+    usernames = dict(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', 'username'))
+    for row in rows:
+        row[f'{relation}__username'] = usernames.get(row[f'{relation}_id'])
+    return rows
+
+
+class ChatShardRouter:
+    """
+    Places chats, their memberships and messages on the shard picked by the hash of the chat id.
+    Everything else, users and tokens included, stays on the global database.
+
+    Objects are routed by themselves and lookups through an object by its shard, other queries of the
+    sharded models have to name their shard with `using(shard_for(chat_id))` or run on all of them with `scatter`
+    """
+
+    def db_for_read(self, model, **hints):
+        return self.db_for_model(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_model(model, hints.get('instance'))
+
+    def db_for_model(self, model, instance):
+        if not is_sharded() or instance is None:
+            return None
+        if model._meta.label_lower in SHARDED_MODELS:
+            if instance._meta.label_lower == 'chats.chat':
+                chat_id = instance.pk
+            elif instance._meta.label_lower in SHARDED_MODELS:
+                chat_id = instance.chat_id
+            else:
+                return None
+            return shard_for(chat_id) if chat_id is not None else None
+        # Users of a chat or a message are not on its shard
+        if instance._state.db in get_shards():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Chats refer to the users of the global database, these foreign keys have no database constraints
+        if is_sharded():
+            databases = {DEFAULT_DB_ALIAS, *get_shards()}
+            if obj1._state.db in databases and obj2._state.db in databases:
+                return True
+        return None
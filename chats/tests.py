@@ -1,9 +1,48 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from io import StringIO
+from unittest import mock, skipIf
+from urllib.request import urlopen
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.db import connection, connections, router
+from django.db.models import Count
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
 from knox.models import AuthToken
 
+from chats import api, renderers
+from chats.cache import TailCache, tail_cache
+from chats.ingest import GroupCommitter, write_messages
+from chats.management.commands.serve import WorkerServer
+from chats.models import Chat, ChatKey, Membership, Message
+from chats.representations import CHAT_PREVIEW_VALUES, MESSAGE_VALUES, represent_chats, represent_messages
+from chats.serializers import ChatPreviewSerializer, MessagePreviewSerializer
+from chats.pubsub import chat_channel, get_broker
+from chats.sharding import shard_for
+from accounts.auth import token_cache
+from oil_test.asgi import application
+from oil_test.postgresql_pool.pool import ConnectionPool, PoolTimeout, close_pool, get_pool
+from oil_test.replicas import ReplicaPinningMiddleware, use_primary, use_replica
+
+
+SHARDS = settings.TEST_CHATS_SHARDS
+
 
 class CreateChatTestCase(APITestCase):
 
@@ -95,6 +134,23 @@ class CreateChatTestCase(APITestCase):
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0], 'One or more invited users are not registered yet')
 
+    def test_create_task_constant_queries(self):
+        users = [User(username=f'user{i}') for i in range(20)]
+        User.objects.bulk_create(users)
+        pks = list(User.objects.filter(username__startswith='user').values_list('pk', flat=True))
+        self.client.post(self.create_chat_url, data={'invited': '[]'})
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.post(self.create_chat_url, data={'invited': f'[{pks[0]}]'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.post(self.create_chat_url, data={'invited': str(pks)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['chat']['participants']), 21)
+
+        self.assertEqual(len(few), len(many))
+
     def test_not_authenticated_user_fail(self):
         self.client.credentials(HTTP_AUTHORIZATION='')
 
@@ -154,6 +210,18 @@ class SendMessageTestCase(APITestCase):
         # Go back to the original user
         self.api_authentication()
 
+    def test_send_message_seq(self):
+        other_chat = self.test_create_chat()
+        seqs = []
+        for chat_id in (self.chat['id'], self.chat['id'], other_chat['id'], self.chat['id']):
+            response = self.client.post(reverse('send-message', kwargs={'pk': chat_id}), data={'text': 'Hello!'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            seqs.append(response.data['message']['seq'])
+
+        # Every chat is numbered on its own
+        self.assertEqual(seqs, [1, 2, 1, 3])
+        self.assertEqual(Chat.objects.get(pk=self.chat['id']).last_seq, 3)
+
     def test_send_message_fail_missing_text(self):
         data = {}
         response = self.client.post(reverse('send-message', kwargs={'pk': self.chat['id']}), data=data)
@@ -193,11 +261,87 @@ class SendMessageTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
 
+class SendMessagesTestCase(APITestCase):
+
+    create_chat_url = reverse('create-chat')
+    send_messages_url = reverse('send-messages')
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.chat1 = self.create_chat()
+        self.chat2 = self.create_chat()
+
+        # A chat of the mock user only
+        mock_token = AuthToken.objects.create(user=self.mock_user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + mock_token)
+        self.foreign_chat = self.create_chat(invited='[]')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def create_chat(self, invited=None):
+        response = self.client.post(self.create_chat_url, data={'invited': invited or f'[{self.mock_user.pk}]'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['chat']
+
+    def test_send_messages_success(self):
+        messages = [
+            {'chat_id': self.chat1['id'], 'text': 'Hey!'},
+            {'chat_id': self.chat2['id'], 'text': 'Hello'},
+            {'chat_id': self.foreign_chat['id'], 'text': 'Intruder'},
+            {'chat_id': self.chat1['id'], 'text': ''},
+            {'chat_id': self.chat1['id'], 'text': 'Whats up?'},
+        ]
+        response = self.client.post(self.send_messages_url, data={'messages': json.dumps(messages)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        results = response.data['results']
+        self.assertEqual(len(results), len(messages))
+        self.assertEqual(results[0]['message']['text'], 'Hey!')
+        self.assertEqual(results[0]['message']['author']['id'], self.user.pk)
+        self.assertIsNotNone(results[0]['message']['id'])
+        self.assertEqual(results[1]['message']['text'], 'Hello')
+        self.assertEqual(results[2]['error'], 'Chat does not exist')
+        self.assertEqual(results[3]['error'], 'Message text should be a non-empty string')
+        self.assertEqual(results[4]['message']['text'], 'Whats up?')
+
+        self.assertEqual([results[i]['message']['seq'] for i in (0, 1, 4)], [1, 1, 2])
+
+        chat1 = Chat.objects.get(pk=self.chat1['id'])
+        self.assertEqual(chat1.last_message_id, results[4]['message']['id'])
+        self.assertEqual(chat1.messages.count(), 2)
+        self.assertEqual(chat1.memberships.get(user=self.user).last_read_message_id, chat1.last_message_id)
+
+    def test_send_messages_json_body(self):
+        messages = [{'chat_id': self.chat1['id'], 'text': 'Hey!'}]
+        response = self.client.post(self.send_messages_url, data={'messages': messages}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['results'][0]['message']['text'], 'Hey!')
+
+    def test_send_messages_fail_invalid_json(self):
+        response = self.client.post(self.send_messages_url, data={'messages': '[{'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], '`messages` parameter is a json-like list of objects')
+
+    def test_send_messages_fail_missing_messages(self):
+        response = self.client.post(self.send_messages_url, data={})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], '`messages` parameter should not be missing')
+
+    def test_not_authenticated_user_fail(self):
+        self.client.credentials(HTTP_AUTHORIZATION='')
+
+        response = self.client.post(self.send_messages_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
 class ChatHistoryTestCase(APITestCase):
 
     create_chat_url = reverse('create-chat')
 
     def setUp(self):
+        tail_cache.clear()
         self.user = User.objects.create_user(username='test', password='test')
         self.token = AuthToken.objects.create(user=self.user)[1]
         self.api_authentication()
@@ -243,7 +387,7 @@ class ChatHistoryTestCase(APITestCase):
         response = self.client.get(reverse('chat-history', kwargs={'pk': self.chat['id']}))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        messages_history = response.data
+        messages_history = response.data['results']
         self.assertEqual(len(messages), len(messages_history))
         for i, message in enumerate(messages):
             self.assertEqual(message[0], messages_history[i]['author']['id'])
@@ -263,7 +407,7 @@ class ChatHistoryTestCase(APITestCase):
         response = self.client.get(reverse('chat-history', kwargs={'pk': self.chat['id']}))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        messages_history = response.data
+        messages_history = response.data['results']
         self.assertEqual(len(messages), len(messages_history))
         for i, message in enumerate(messages):
             self.assertEqual(message[0], messages_history[i]['author']['id'])
@@ -291,6 +435,179 @@ class ChatHistoryTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.assertEqual(response.data, 'Chat does not exist')
 
+    def test_get_history_paginated(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+
+        response = self.client.get(url, data={'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['text'] for m in response.data['results']], ['Whats up?', 'Nothing'])
+        self.assertIsNone(response.data['next'])
+        self.assertIsNotNone(response.data['previous'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['text'] for m in response.data['results']], ['Hey!'])
+        self.assertIsNone(response.data['previous'])
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['text'] for m in response.data['results']], ['Whats up?', 'Nothing'])
+        self.assertIsNone(response.data['next'])
+
+    def assert_compact_history(self, history, full_history):
+        self.assertEqual(history['authors'], [{'id': self.user.pk, 'username': self.user.username},
+                                              {'id': self.mock_user.pk, 'username': self.mock_user.username}])
+        authors = {author['id']: author for author in history['authors']}
+        messages = history['messages']
+        self.assertEqual([{
+            'id': messages['id'][i],
+            'seq': messages['seq'][i],
+            'author': authors[messages['author'][i]],
+            'text': messages['text'][i],
+            'created_at': messages['created_at'][i],
+        } for i in range(len(messages['id']))], full_history)
+
+    def test_get_history_compact(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+        full_history = json.loads(self.client.get(url).content)['results']
+
+        response = self.client.get(url, data={'format': 'compact'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assert_compact_history(json.loads(response.content)['results'], full_history)
+
+        response = self.client.get(url, HTTP_ACCEPT='application/vnd.chats.compact+json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/vnd.chats.compact+json')
+        self.assert_compact_history(json.loads(response.content)['results'], full_history)
+
+    def test_get_history_compact_paginated(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+
+        response = self.client.get(url, data={'page_size': 2}, HTTP_ACCEPT='application/vnd.chats.compact+json')
+        self.assertEqual(response.data['results']['messages']['text'], ['Whats up?', 'Nothing'])
+
+        response = self.client.get(response.data['previous'], HTTP_ACCEPT='application/vnd.chats.compact+json')
+        self.assertEqual(response.data['results']['messages']['text'], ['Hey!'])
+        self.assertEqual(response.data['results']['authors'], [{'id': self.user.pk, 'username': self.user.username}])
+
+    @skipIf(renderers.msgpack is None, 'msgpack is not installed')
+    def test_get_history_msgpack(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+        full_history = json.loads(self.client.get(url).content)['results']
+
+        response = self.client.get(url, HTTP_ACCEPT='application/x-msgpack')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        self.assert_compact_history(renderers.msgpack.unpackb(response.content)['results'], full_history)
+
+    def test_get_history_not_modified(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(len(queries), 1)
+
+        # Other pages and formats are tagged on their own
+        response = self.client.get(url, data={'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url, data={'format': 'compact'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.client.post(reverse('send-message', kwargs={'pk': self.chat['id']}), data={'text': 'Again'})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][-1]['text'], 'Again')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_history_ignores_modified_since(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+
+        # A message sent within the same second as the last one would be missed
+        self.client.post(reverse('send-message', kwargs={'pk': self.chat['id']}), data={'text': 'Again'})
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][-1]['text'], 'Again')
+
+    def test_get_history_not_modified_fail_user(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+        etag = self.client.get(url)['ETag']
+
+        fail_user = User.objects.create_user(username='fail_user', password='test')
+        token = AuthToken.objects.create(user=fail_user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.api_authentication()
+
+    def test_export_history(self):
+        response = self.client.get(reverse('chat-export', kwargs={'pk': self.chat['id']}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        exported = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        history = self.client.get(reverse('chat-history', kwargs={'pk': self.chat['id']})).data['results']
+        self.assertEqual(exported, json.loads(json.dumps(history)))
+
+    def test_export_history_fail_user(self):
+        fail_user = User.objects.create_user(username='fail_user', password='test')
+        token = AuthToken.objects.create(user=fail_user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+
+        response = self.client.get(reverse('chat-export', kwargs={'pk': self.chat['id']}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.api_authentication()
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command('exportchat', self.chat['id'], chunk_size=2, stdout=out)
+        self.assertEqual([json.loads(line)['text'] for line in out.getvalue().splitlines()],
+                         ['Hey!', 'Whats up?', 'Nothing'])
+
+    def test_get_history_after_seq(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+
+        response = self.client.get(url)
+        self.assertEqual([m['seq'] for m in response.data['results']], [1, 2, 3])
+
+        response = self.client.get(url, data={'after_seq': 1, 'page_size': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(m['seq'], m['text']) for m in response.data['results']], [(2, 'Whats up?')])
+        self.assertIsNotNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([(m['seq'], m['text']) for m in response.data['results']], [(3, 'Nothing')])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([m['seq'] for m in response.data['results']], [2])
+
+        response = self.client.get(url, data={'after_seq': 3})
+        self.assertEqual(response.data['results'], [])
+
+    def test_get_history_fail_after_seq(self):
+        url = reverse('chat-history', kwargs={'pk': self.chat['id']})
+
+        response = self.client.get(url, data={'after_seq': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        before = self.client.get(url, data={'page_size': 1}).data['previous']
+        response = self.client.get(before + '&after_seq=1')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_history_fail_invalid_cursor(self):
+        response = self.client.get(reverse('chat-history', kwargs={'pk': self.chat['id']}), data={'before': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_not_authenticated_user_fail(self):
         self.client.credentials(HTTP_AUTHORIZATION='')
 
@@ -367,8 +684,1320 @@ class UserChatsTestCase(APITestCase):
         # Go back to the original user
         self.api_authentication()
 
+    def test_user_chats_not_modified(self):
+        response = self.client.get(self.user_chats_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.user_chats_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(len(queries), 1)
+
+        response = self.client.get(self.user_chats_url, HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Another user with the same chats gets another tag
+        token = AuthToken.objects.create(user=self.mock_user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+        response = self.client.get(self.user_chats_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.api_authentication()
+
+        self.test_create_chat()
+        response = self.client.get(self.user_chats_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3)
+        self.assertNotEqual(response['ETag'], etag)
+
     def test_not_authenticated_user_fail(self):
         self.client.credentials(HTTP_AUTHORIZATION='')
 
         response = self.client.get(self.user_chats_url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ChatSyncTestCase(APITestCase):
+
+    create_chat_url = reverse('create-chat')
+    sync_url = reverse('chat-sync')
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.api_authentication()
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.chat1 = self.create_chat()
+        self.chat2 = self.create_chat()
+        self.messages1 = [self.send_message(self.chat1, text) for text in ('Hey!', 'Whats up?', 'Nothing')]
+        self.messages2 = [self.send_message(self.chat2, text) for text in ('Hello', 'Bye')]
+
+    def api_authentication(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def create_chat(self):
+        response = self.client.post(self.create_chat_url, data={'invited': f'[{self.mock_user.pk}]'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['chat']
+
+    def send_message(self, chat, text):
+        response = self.client.post(reverse('send-message', kwargs={'pk': chat['id']}), data={'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['message']
+
+    def test_sync_success(self):
+        since = [f'{self.chat1["id"]}:{self.messages1[0]["id"]}', f'{self.chat2["id"]}:{self.messages2[1]["id"]}']
+        response = self.client.get(self.sync_url, data={'since': since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['has_more'])
+
+        chats = response.data['chats']
+        self.assertEqual(len(chats), 1)
+        self.assertEqual(chats[0]['id'], self.chat1['id'])
+        self.assertEqual([m['text'] for m in chats[0]['messages']], ['Whats up?', 'Nothing'])
+
+    def test_sync_from_scratch(self):
+        response = self.client.get(self.sync_url, data={'since': f'{self.chat2["id"]}:0'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['text'] for m in response.data['chats'][0]['messages']], ['Hello', 'Bye'])
+
+    def test_sync_constant_queries(self):
+        for i in range(10):
+            self.send_message(self.chat2, f'Message {i}')
+
+        # The chats of the user, the positions of the known messages and the new messages with their authors
+        since = [f'{self.chat1["id"]}:0', f'{self.chat2["id"]}:0']
+        with self.assertNumQueries(3):
+            response = self.client.get(self.sync_url, data={'since': since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['chats'][0]['messages'], self.messages1)
+        self.assertEqual(len(response.data['chats'][1]['messages']), 12)
+
+    def test_sync_ignores_foreign_chats(self):
+        fail_user = User.objects.create_user(username='fail_user', password='test')
+        token = AuthToken.objects.create(user=fail_user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+
+        response = self.client.get(self.sync_url, data={'since': f'{self.chat1["id"]}:0'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['chats'], [])
+
+        self.api_authentication()
+
+    def test_sync_fail_invalid_since(self):
+        response = self.client.get(self.sync_url, data={'since': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sync_long_polling_timeout(self):
+        started = time.monotonic()
+        response = self.client.get(self.sync_url, data={
+            'since': f'{self.chat1["id"]}:{self.messages1[-1]["id"]}',
+            'timeout': 0.2,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['chats'], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_not_authenticated_user_fail(self):
+        self.client.credentials(HTTP_AUTHORIZATION='')
+
+        response = self.client.get(self.sync_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ChatSyncPollingTestCase(APITransactionTestCase):
+    """Messages are sent from another thread while a sync request waits"""
+
+    sync_url = reverse('chat-sync')
+
+    def setUp(self):
+        tail_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+        self.message = Message.objects.create(chat=self.chat, author=self.user, text='Hello!')
+
+    def sync_while(self, send):
+        def run():
+            try:
+                send()
+            finally:
+                connection.close()
+
+        sender = threading.Timer(0.1, run)
+        sender.start()
+        started = time.monotonic()
+        response = self.client.get(self.sync_url, data={'since': f'{self.chat.pk}:{self.message.pk}', 'timeout': 10})
+        sender.join()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertLess(time.monotonic() - started, 5)
+        return [m['text'] for chat in response.data['chats'] for m in chat['messages']]
+
+    def test_sync_long_polling_wakes_up(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        texts = self.sync_while(lambda: client.post(reverse('send-message', kwargs={'pk': self.chat.pk}),
+                                                    data={'text': 'Again'}))
+        self.assertEqual(texts, ['Again'])
+
+    # Sent well before the next poll, SQLite locks whole tables while writing
+    @override_settings(CHATS_SYNC_POLL_INTERVAL=0.5)
+    def test_sync_long_polling_unannounced(self):
+        # Like a message sent through another process, nothing is published in this one
+        texts = self.sync_while(lambda: Message.objects.create(chat=self.chat, author=self.user, text='Again'))
+        self.assertEqual(texts, ['Again'])
+
+    def test_sync_long_polling_wakes_up_without_messages(self):
+        # A notification that brings no new message does not end the wait
+        publisher = threading.Timer(0.1, get_broker().publish, args=(chat_channel(self.chat.pk), {}))
+        publisher.start()
+        started = time.monotonic()
+        response = self.client.get(self.sync_url, data={'since': f'{self.chat.pk}:{self.message.pk}',
+                                                         'timeout': 0.5})
+        publisher.join()
+        self.assertEqual(response.data['chats'], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+
+
+class ChatBootstrapTestCase(APITestCase):
+
+    create_chat_url = reverse('create-chat')
+    bootstrap_url = reverse('chat-bootstrap')
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.chats = [self.create_chat() for _ in range(3)]
+        for chat in self.chats[:2]:
+            for i in range(5):
+                self.send_message(chat, f'Message {i}')
+
+    def create_chat(self):
+        response = self.client.post(self.create_chat_url, data={'invited': f'[{self.mock_user.pk}]'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['chat']
+
+    def send_message(self, chat, text):
+        response = self.client.post(reverse('send-message', kwargs={'pk': chat['id']}), data={'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_bootstrap_success(self):
+        response = self.client.get(self.bootstrap_url, data={'limit': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        chats = response.data
+        self.assertEqual([chat['id'] for chat in chats], [chat['id'] for chat in self.chats])
+        self.assertEqual([m['text'] for m in chats[0]['messages']], ['Message 2', 'Message 3', 'Message 4'])
+        self.assertEqual([m['text'] for m in chats[1]['messages']], ['Message 2', 'Message 3', 'Message 4'])
+        self.assertEqual(chats[2]['messages'], [])
+        self.assertEqual(chats[0]['messages'][0]['author']['id'], self.user.pk)
+
+    def test_bootstrap_constant_queries(self):
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(self.bootstrap_url)
+        for _ in range(3):
+            self.send_message(self.create_chat(), 'Hello')
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(self.bootstrap_url)
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(len(few), len(many))
+
+    def test_bootstrap_chat_created_meanwhile(self):
+        list_chats = api.on_all_shards
+
+        def list_then_create(queryset):
+            chats = list(list_chats(queryset))
+            self.send_message(self.create_chat(), 'Hello')
+            return chats
+
+        with mock.patch.object(api, 'on_all_shards', list_then_create):
+            response = self.client.get(self.bootstrap_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([chat['id'] for chat in response.data], [chat['id'] for chat in self.chats])
+
+    def test_not_authenticated_user_fail(self):
+        self.client.credentials(HTTP_AUTHORIZATION='')
+
+        response = self.client.get(self.bootstrap_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ChatInboxTestCase(APITestCase):
+
+    create_chat_url = reverse('create-chat')
+    inbox_url = reverse('chat-inbox')
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.api_authentication()
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.mock_token = AuthToken.objects.create(user=self.mock_user)[1]
+        self.chat1 = self.create_chat()
+        self.chat2 = self.create_chat()
+        self.chat3 = self.create_chat()
+        self.send_message(self.chat1, 'Hey!')
+        self.send_message(self.chat2, 'Hello')
+
+        # The mock user answers in the first chat, so it becomes the most recent one
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.mock_token)
+        self.send_message(self.chat1, 'Whats up?')
+        self.send_message(self.chat1, 'Anyone?')
+        self.api_authentication()
+
+    def api_authentication(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def create_chat(self):
+        response = self.client.post(self.create_chat_url, data={'invited': f'[{self.mock_user.pk}]'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['chat']
+
+    def send_message(self, chat, text):
+        response = self.client.post(reverse('send-message', kwargs={'pk': chat['id']}), data={'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['message']
+
+    def test_inbox_success(self):
+        response = self.client.get(self.inbox_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        chats = response.data['results']
+        self.assertEqual([chat['id'] for chat in chats], [self.chat1['id'], self.chat2['id'], self.chat3['id']])
+        self.assertEqual(chats[0]['last_message']['text'], 'Anyone?')
+        self.assertEqual(chats[0]['last_message']['author']['id'], self.mock_user.pk)
+        self.assertEqual([chat['unread_count'] for chat in chats], [2, 0, 0])
+        self.assertIsNone(chats[2]['last_message'])
+
+    def test_inbox_paginated(self):
+        response = self.client.get(self.inbox_url, data={'page_size': 2})
+        self.assertEqual([chat['id'] for chat in response.data['results']], [self.chat1['id'], self.chat2['id']])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([chat['id'] for chat in response.data['results']], [self.chat3['id']])
+
+    def test_mark_read(self):
+        response = self.client.post(reverse('chat-read', kwargs={'pk': self.chat1['id']}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(self.inbox_url)
+        self.assertEqual(response.data['results'][0]['unread_count'], 0)
+
+    def test_mark_read_up_to_message(self):
+        message_id = Chat.objects.get(pk=self.chat1['id']).last_message_id
+        response = self.client.post(reverse('chat-read', kwargs={'pk': self.chat1['id']}),
+                                    data={'message_id': message_id - 1})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(self.inbox_url)
+        self.assertEqual(response.data['results'][0]['unread_count'], 1)
+
+    def test_mark_read_capped_at_last_message(self):
+        response = self.client.post(reverse('chat-read', kwargs={'pk': self.chat1['id']}),
+                                    data={'message_id': 10 ** 9})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.mock_token)
+        self.send_message(self.chat1, 'Still there?')
+        self.api_authentication()
+        response = self.client.get(self.inbox_url)
+        self.assertEqual(response.data['results'][0]['unread_count'], 1)
+
+    def test_mark_read_fail_not_integer(self):
+        for message_id in ('first', [1], {'id': 1}):
+            response = self.client.post(reverse('chat-read', kwargs={'pk': self.chat1['id']}),
+                                        data={'message_id': message_id}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_mark_read_fail_not_participant(self):
+        fail_user = User.objects.create_user(username='fail_user', password='test')
+        token = AuthToken.objects.create(user=fail_user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+
+        response = self.client.post(reverse('chat-read', kwargs={'pk': self.chat1['id']}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data, 'Chat does not exist')
+
+        self.api_authentication()
+
+    def test_not_authenticated_user_fail(self):
+        self.client.credentials(HTTP_AUTHORIZATION='')
+
+        response = self.client.get(self.inbox_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ChatWebSocketTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.fail_user = User.objects.create_user(username='fail_user', password='test')
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def connect(self, token, chat_id=None):
+        return ApplicationCommunicator(application, {
+            'type': 'websocket',
+            'path': f'/ws/chats/{chat_id or self.chat.pk}',
+            'query_string': f'token={token}'.encode(),
+            'headers': [],
+        })
+
+    def test_message_pushed(self):
+        async def scenario():
+            communicator = self.connect(self.token)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(1))['type'], 'websocket.accept')
+
+            response = await sync_to_async(self.client.post)(
+                reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': 'Hello!'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+            event = await communicator.receive_output(1)
+            self.assertEqual(event['type'], 'websocket.send')
+            message = json.loads(event['text'])['message']
+            self.assertEqual(message['id'], response.data['message']['id'])
+            self.assertEqual(message['text'], 'Hello!')
+
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(1)
+
+        async_to_sync(scenario)()
+
+    def test_not_participant_rejected(self):
+        async def scenario():
+            token = await sync_to_async(lambda: AuthToken.objects.create(user=self.fail_user)[1])()
+            communicator = self.connect(token)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(1))['type'], 'websocket.close')
+
+        async_to_sync(scenario)()
+
+    def test_not_authenticated_rejected(self):
+        async def scenario():
+            communicator = self.connect('invalid')
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(1))['type'], 'websocket.close')
+
+        async_to_sync(scenario)()
+
+
+class TailCacheTestCase(APITransactionTestCase):
+    """Sends write through to the cache on commit, so the transactions are real"""
+
+    def setUp(self):
+        tail_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+        for text in ('One', 'Two', 'Three'):
+            self.send(text)
+        self.history_url = reverse('chat-history', kwargs={'pk': self.chat.pk})
+
+    def send(self, text):
+        response = self.client.post(reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['message']
+
+    def history(self, **params):
+        response = self.client.get(self.history_url, data=params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_history_served_from_cache(self):
+        expected = self.history().content
+        self.assertEqual(tail_cache.stats()['misses'], 1)
+
+        # Only the version of the chat is read
+        with self.assertNumQueries(1):
+            response = self.history()
+        self.assertEqual(response.content, expected)
+        self.assertEqual(tail_cache.stats()['hits'], 1)
+
+        response = self.history(page_size=2)
+        self.assertEqual([m['text'] for m in response.data['results']], ['Two', 'Three'])
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([m['text'] for m in response.data['results']], ['One'])
+        self.assertEqual(tail_cache.stats()['hits'], 2)
+
+    def test_send_writes_through(self):
+        self.history()
+        self.send('Four')
+
+        response = self.history()
+        self.assertEqual([m['text'] for m in response.data['results']], ['One', 'Two', 'Three', 'Four'])
+        self.assertEqual(tail_cache.stats()['hits'], 1)
+        self.assertEqual(tail_cache.stats()['misses'], 1)
+
+    def test_changes_of_other_processes_are_caught(self):
+        self.history()
+
+        # Written without going through this process' cache
+        message = Message.objects.create(chat=self.chat, author=self.user, text='Elsewhere')
+        self.assertEqual([m['text'] for m in self.history().data['results']], ['One', 'Two', 'Three', 'Elsewhere'])
+
+        message.text = 'Edited'
+        message.save()
+        self.assertEqual(self.history().data['results'][-1]['text'], 'Edited')
+
+        message.delete()
+        self.assertEqual([m['text'] for m in self.history().data['results']], ['One', 'Two', 'Three'])
+        self.assertEqual(tail_cache.stats()['hits'], 0)
+
+    def test_bulk_delete_bumps_generation_once(self):
+        self.history()
+        generation = Chat.objects.get(pk=self.chat.pk).generation
+
+        Message.objects.filter(chat=self.chat, text__in=['Two', 'Three']).delete()
+        self.assertEqual(Chat.objects.get(pk=self.chat.pk).generation, generation + 1)
+        self.assertEqual([m['text'] for m in self.history().data['results']], ['One'])
+
+    def test_chat_delete_constant_queries(self):
+        with CaptureQueriesContext(connection) as few:
+            Chat.objects.get(pk=self.chat.pk).delete()
+
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+        for i in range(20):
+            self.send(f'Message {i}')
+        with CaptureQueriesContext(connection) as many:
+            Chat.objects.get(pk=self.chat.pk).delete()
+        self.assertEqual(len(few), len(many))
+        self.assertFalse(Message.objects.exists())
+
+    def test_interleaved_send_is_not_written_through(self):
+        self.history()
+
+        message = Message.objects.create(chat=self.chat, author=self.user, text='Elsewhere')
+        self.send('Here')
+
+        self.assertEqual([m['text'] for m in self.history().data['results']],
+                         ['One', 'Two', 'Three', 'Elsewhere', 'Here'])
+        self.assertEqual(tail_cache.stats()['hits'], 0)
+
+    def test_least_recently_used_chat_is_evicted(self):
+        cache = TailCache(max_chats=1, max_messages=2)
+        other = Chat.objects.create(creator=self.user)
+
+        self.assertEqual([m['text'] for m in cache.latest(self.chat.pk, self.chat.generation, 2)], ['Three', 'Two'])
+        self.assertIsNone(cache.latest(self.chat.pk, self.chat.generation, 3))
+        cache.latest(other.pk, 0, 1)
+
+        self.assertNotIn(self.chat.pk, cache)
+        self.assertIn(other.pk, cache)
+
+    def test_stats_admin_only(self):
+        response = self.client.get(reverse('chat-cache'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + AuthToken.objects.create(user=self.user)[1])
+        tail_cache.clear()
+        self.history()
+        self.history()
+
+        response = self.client.get(reverse('chat-cache'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'chats': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+
+class GroupCommitterTestCase(SimpleTestCase):
+
+    def submit_concurrently(self, committer, values):
+        results = {}
+        barrier = threading.Barrier(len(values))
+
+        def submit(value):
+            barrier.wait()
+            try:
+                results[value] = committer.submit(value)
+            except Exception as e:
+                results[value] = e
+
+        threads = [threading.Thread(target=submit, args=(value, )) for value in values]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+        return results
+
+    def test_concurrent_submits_are_flushed_together(self):
+        groups = []
+
+        def flush(values):
+            groups.append(sorted(values))
+            return [value * 2 for value in values]
+
+        committer = GroupCommitter(flush, window=60, max_batch=4)
+        started = time.monotonic()
+        results = self.submit_concurrently(committer, [1, 2, 3, 4])
+
+        # A full group does not wait for the window to end
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(groups, [[1, 2, 3, 4]])
+        self.assertEqual(results, {1: 2, 2: 4, 3: 6, 4: 8})
+
+    def test_window_bounds_the_wait(self):
+        committer = GroupCommitter(lambda values: values, window=0.05, max_batch=100)
+        started = time.monotonic()
+        self.assertEqual(committer.submit('message'), 'message')
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_errors_reach_every_submitter(self):
+        def flush(values):
+            raise ValueError('Flush failed')
+
+        committer = GroupCommitter(flush, window=60, max_batch=3)
+        results = self.submit_concurrently(committer, [1, 2, 3])
+        self.assertEqual(len(results), 3)
+        for result in results.values():
+            self.assertIsInstance(result, ValueError)
+
+
+@override_settings(CHATS_GROUP_COMMIT=True)
+class GroupCommitSendTestCase(APITransactionTestCase):
+
+    def setUp(self):
+        tail_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user, self.mock_user)
+
+    def test_send_message(self):
+        response = self.client.post(reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': 'Hello!'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        message = Message.objects.get()
+        self.assertEqual(response.data['message']['id'], message.pk)
+        self.assertEqual(response.data['message']['author']['id'], self.user.pk)
+        self.assertEqual(Chat.objects.get().last_message_id, message.pk)
+        self.assertEqual(Membership.objects.get(chat=self.chat, user=self.user).last_read_message_id, message.pk)
+        self.assertEqual(Membership.objects.get(chat=self.chat, user=self.mock_user).last_read_message_id, 0)
+
+    def test_send_message_fail_user(self):
+        fail_user = User.objects.create_user(username='fail_user', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + AuthToken.objects.create(user=fail_user)[1])
+
+        response = self.client.post(reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': 'Hello!'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Message.objects.exists())
+
+    def test_send_writes_through(self):
+        history_url = reverse('chat-history', kwargs={'pk': self.chat.pk})
+        self.client.get(history_url)
+        self.client.post(reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': 'Hello!'})
+
+        response = self.client.get(history_url)
+        self.assertEqual([m['text'] for m in response.data['results']], ['Hello!'])
+        self.assertEqual(tail_cache.stats()['hits'], 1)
+
+    def test_batch_of_several_authors(self):
+        other = Chat.objects.create(creator=self.mock_user)
+        other.participants.add(self.mock_user)
+        messages = write_messages([Message(chat_id=self.chat.pk, author=self.user, text='One'),
+                                   Message(chat_id=self.chat.pk, author=self.mock_user, text='Two'),
+                                   Message(chat_id=other.pk, author=self.mock_user, text='Three')])
+
+        self.assertTrue(all(message.pk for message in messages))
+        self.assertEqual(Chat.objects.get(pk=self.chat.pk).last_message_id, messages[1].pk)
+        self.assertEqual(Chat.objects.get(pk=other.pk).last_message_id, messages[2].pk)
+        read = dict(Membership.objects.filter(user=self.mock_user).values_list('chat_id', 'last_read_message_id'))
+        self.assertEqual(read, {self.chat.pk: messages[1].pk, other.pk: messages[2].pk})
+        self.assertEqual(Membership.objects.get(chat=self.chat, user=self.user).last_read_message_id, messages[0].pk)
+
+    def test_batch_with_deleted_chat(self):
+        deleted = Chat.objects.create(creator=self.mock_user)
+        deleted_id = deleted.pk
+        deleted.delete()
+        messages = write_messages([Message(chat_id=self.chat.pk, author=self.user, text='One'),
+                                   Message(chat_id=deleted_id, author=self.mock_user, text='Two')])
+
+        # Only the message of the deleted chat is left out
+        self.assertIsNotNone(messages[0].pk)
+        self.assertIsNone(messages[1].pk)
+        self.assertEqual(list(Message.objects.values_list('text', flat=True)), ['One'])
+        self.assertEqual(Chat.objects.get(pk=self.chat.pk).last_message_id, messages[0].pk)
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestCase(APITransactionTestCase):
+    """
+    The replica is a second connection to the test database, so it is always up to date.
+    It is added once the test database exists and is flushed along with the default one
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        connections.databases['replica'] = dict(connections.databases['default'])
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        tail_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+        Message.objects.create(chat=self.chat, author=self.user, text='Hello!')
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return primary, replica
+
+    def test_reads_go_to_replica(self):
+        for url in (reverse('chat-history', kwargs={'pk': self.chat.pk}), reverse('chat-user')):
+            primary, replica = self.get(url)
+            self.assertTrue(replica)
+            self.assertFalse(any('chats_' in query['sql'] for query in primary))
+
+    def test_authentication_reads_primary(self):
+        primary, replica = self.get(reverse('chat-user'))
+        self.assertTrue(any('knox_authtoken' in query['sql'] for query in primary))
+        self.assertFalse(any('knox_authtoken' in query['sql'] for query in replica))
+
+    def test_writer_is_pinned_to_primary(self):
+        response = self.client.post(reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': 'Again'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        primary, replica = self.get(reverse('chat-history', kwargs={'pk': self.chat.pk}))
+        self.assertFalse(replica)
+        self.assertTrue(primary)
+
+        # Other users are not pinned
+        other = User.objects.create_user(username='other', password='other')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + AuthToken.objects.create(user=other)[1])
+        primary, replica = self.get(reverse('chat-user'))
+        self.assertTrue(replica)
+
+    def test_pinning_middleware_async(self):
+        async def get_response(request):
+            return HttpResponse(status=status.HTTP_201_CREATED)
+
+        # Django only runs async views without switching to the thread of the sync code if the middleware allows it
+        middleware = ReplicaPinningMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        request = AsyncRequestFactory().post('/')
+        request.user = self.user
+        response = async_to_sync(middleware)(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        primary, replica = self.get(reverse('chat-user'))
+        self.assertFalse(replica)
+
+    @override_settings(REPLICA_PIN_SECONDS=0.1)
+    def test_pin_expires(self):
+        self.client.post(reverse('send-message', kwargs={'pk': self.chat.pk}), data={'text': 'Again'})
+        time.sleep(0.2)
+
+        primary, replica = self.get(reverse('chat-history', kwargs={'pk': self.chat.pk}))
+        self.assertTrue(replica)
+
+    def test_writes_go_to_primary(self):
+        use_replica()
+        try:
+            message = Message.objects.get()
+            self.assertEqual(message._state.db, 'replica')
+            self.assertEqual(router.db_for_write(Message, instance=message), 'default')
+        finally:
+            use_primary()
+        self.assertEqual(router.db_for_read(Message), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'chats'))
+
+
+@override_settings(CHATS_SHARDS=SHARDS)
+class ShardingTestCase(APITransactionTestCase):
+    databases = {'default', *SHARDS}
+    # Chats are numbered from 1 in every test, so that they land on both shards
+    reset_sequences = True
+
+    create_chat_url = reverse('create-chat')
+
+    def setUp(self):
+        token_cache.clear()
+        tail_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = AuthToken.objects.create(user=self.user)[1]
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.mock_token = AuthToken.objects.create(user=self.mock_user)[1]
+        self.api_authentication()
+        self.chats = [self.create_chat() for _ in range(6)]
+        self.messages = [self.send_message(chat, f'Hello {chat["id"]}') for chat in self.chats]
+
+    def api_authentication(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def create_chat(self):
+        response = self.client.post(self.create_chat_url, data={'invited': f'[{self.mock_user.pk}]'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['chat']
+
+    def send_message(self, chat, text):
+        response = self.client.post(reverse('send-message', kwargs={'pk': chat['id']}), data={'text': text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['message']
+
+    def test_chats_are_placed_by_id(self):
+        placement = {chat['id']: shard_for(chat['id']) for chat in self.chats}
+        self.assertEqual(set(placement.values()), set(SHARDS))
+
+        for chat_id, shard in placement.items():
+            other = next(alias for alias in SHARDS if alias != shard)
+            self.assertTrue(Chat.objects.using(shard).filter(pk=chat_id).exists())
+            self.assertFalse(Chat.objects.using(other).filter(pk=chat_id).exists())
+            self.assertEqual(Membership.objects.using(shard).filter(chat_id=chat_id).count(), 2)
+            self.assertEqual(Message.objects.using(shard).filter(chat_id=chat_id).count(), 1)
+
+        # Users, tokens and the ids of the chats stay on the global database
+        self.assertFalse(Chat.objects.using('default').exists())
+        self.assertEqual(ChatKey.objects.using('default').count(), len(self.chats))
+        for shard in SHARDS:
+            self.assertFalse(User.objects.using(shard).exists())
+            self.assertFalse(AuthToken.objects.using(shard).exists())
+
+    def test_create_chat(self):
+        chat = self.chats[0]
+        self.assertEqual([user['id'] for user in chat['participants']], [self.user.pk, self.mock_user.pk])
+        self.assertEqual(chat['creator']['username'], 'test')
+
+    def test_routing(self):
+        chat = Chat.objects.using(shard_for(self.chats[0]['id'])).get(pk=self.chats[0]['id'])
+        self.assertEqual(router.db_for_write(Message, instance=Message(chat_id=chat.pk)), shard_for(chat.pk))
+        self.assertEqual(router.db_for_read(Message, instance=chat), shard_for(chat.pk))
+        self.assertEqual(router.db_for_read(User, instance=chat), 'default')
+        self.assertEqual(chat.creator, self.user)
+
+    def test_history(self):
+        for chat, message in zip(self.chats, self.messages):
+            response = self.client.get(reverse('chat-history', kwargs={'pk': chat['id']}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(json.dumps(response.data['results'])), [json.loads(json.dumps(message))])
+            self.assertEqual(response.data['results'][0]['author']['username'], 'test')
+
+    def test_history_fail_user(self):
+        fail_user = User.objects.create_user(username='fail_user', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + AuthToken.objects.create(user=fail_user)[1])
+
+        response = self.client.get(reverse('chat-history', kwargs={'pk': self.chats[0]['id']}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_user_chats(self):
+        url = reverse('chat-user')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([chat['id'] for chat in response.data], [chat['id'] for chat in self.chats])
+        self.assertEqual({chat['creator']['username'] for chat in response.data}, {'test'})
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.mock_token)
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), len(self.chats))
+
+    def test_user_chats_changed(self):
+        url = reverse('chat-user')
+        etag = self.client.get(url)['ETag']
+        chat = self.create_chat()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[-1]['id'], chat['id'])
+
+    def test_inbox(self):
+        # The mock user answers in the second chat, so it becomes the most recent one
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.mock_token)
+        self.send_message(self.chats[1], 'Answer')
+        self.api_authentication()
+
+        expected = [self.chats[1]['id']] + [chat['id'] for chat in reversed(self.chats) if chat is not self.chats[1]]
+        response = self.client.get(reverse('chat-inbox'), data={'page_size': 4})
+        chats = response.data['results']
+        self.assertEqual(chats[0]['last_message']['text'], 'Answer')
+        self.assertEqual(chats[0]['last_message']['author']['username'], 'mock')
+        self.assertEqual([chat['unread_count'] for chat in chats], [1, 0, 0, 0])
+
+        response = self.client.get(response.data['next'])
+        chats += response.data['results']
+        self.assertIsNone(response.data['next'])
+        self.assertEqual([chat['id'] for chat in chats], expected)
+
+    def test_bootstrap(self):
+        response = self.client.get(reverse('chat-bootstrap'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([chat['id'] for chat in response.data], [chat['id'] for chat in self.chats])
+        self.assertEqual([[m['text'] for m in chat['messages']] for chat in response.data],
+                         [[f'Hello {chat["id"]}'] for chat in self.chats])
+
+    def test_sync(self):
+        # Messages of different shards share ids, the one of every chat is looked up on its own shard
+        self.assertLess(len({message['id'] for message in self.messages}), len(self.messages))
+        since = [f'{chat["id"]}:{message["id"]}' for chat, message in zip(self.chats, self.messages)]
+        since[0] = f'{self.chats[0]["id"]}:0'
+        response = self.client.get(reverse('chat-sync'), data={'since': since})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([chat['id'] for chat in response.data['chats']], [self.chats[0]['id']])
+
+        response = self.client.get(reverse('chat-sync'), data={'since': [f'{chat["id"]}:0' for chat in self.chats]})
+        self.assertEqual([chat['id'] for chat in response.data['chats']], [chat['id'] for chat in self.chats])
+
+    def test_send_messages(self):
+        messages = [{'chat_id': chat['id'], 'text': 'Batch'} for chat in self.chats]
+        response = self.client.post(reverse('send-messages'), data={'messages': json.dumps(messages)})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([result['message']['seq'] for result in response.data['results']], [2] * len(self.chats))
+
+        for chat in self.chats:
+            shard = shard_for(chat['id'])
+            self.assertEqual(Chat.objects.using(shard).get(pk=chat['id']).last_seq, 2)
+            self.assertEqual(Message.objects.using(shard).filter(chat_id=chat['id'], text='Batch').count(), 1)
+
+    @override_settings(CHATS_GROUP_COMMIT=True)
+    def test_group_commit(self):
+        message = self.send_message(self.chats[3], 'Grouped')
+        self.assertEqual(message['seq'], 2)
+        self.assertTrue(Message.objects.using(shard_for(self.chats[3]['id'])).filter(pk=message['id'],
+                                                                                     text='Grouped').exists())
+
+    def test_read(self):
+        chat = self.chats[4]
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.mock_token)
+        response = self.client.post(reverse('chat-read', kwargs={'pk': chat['id']}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        membership = Membership.objects.using(shard_for(chat['id'])).get(chat_id=chat['id'], user_id=self.mock_user.pk)
+        self.assertEqual(membership.last_read_message_id, self.messages[4]['id'])
+
+    def test_export(self):
+        chat = self.chats[5]
+        response = self.client.get(reverse('chat-export', kwargs={'pk': chat['id']}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        exported = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(exported, [json.loads(json.dumps(self.messages[5]))])
+
+    def test_export_command(self):
+        for chat, message in zip(self.chats, self.messages):
+            out = StringIO()
+            call_command('exportchat', chat['id'], stdout=out)
+            self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()], [message['id']])
+
+    def test_seed(self):
+        call_command('seed', users=10, chats=8, messages=200, seed=1, stdout=StringIO())
+        chat_ids = ChatKey.objects.filter(pk__gt=len(self.chats)).values_list('pk', flat=True)
+        self.assertEqual(len(chat_ids), 8)
+
+        for chat_id in chat_ids:
+            shard = shard_for(chat_id)
+            chat = Chat.objects.using(shard).get(pk=chat_id)
+            messages = Message.objects.using(shard).filter(chat_id=chat_id)
+            self.assertEqual(chat.last_seq, messages.count())
+            self.assertGreaterEqual(Membership.objects.using(shard).filter(chat_id=chat_id).count(), 2)
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+        self.alive = True
+
+    def close(self):
+        self.closed = True
+
+
+def check_fake_connection(connection):
+    if not connection.alive:
+        raise ConnectionError('Server closed the connection')
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+
+    def get_pool(self, **options):
+        return ConnectionPool(connect=FakeConnection, check=check_fake_connection, **options)
+
+    def test_reuse(self):
+        pool = self.get_pool(min_size=0)
+        connection = pool.checkout()
+        pool.checkin(connection)
+        self.assertIs(pool.checkout(), connection)
+        self.assertEqual(pool.stats()['opened'], 1)
+
+    def test_fill(self):
+        pool = self.get_pool(min_size=3)
+        pool.fill()
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['in_use']), (3, 3, 0))
+
+    def test_timeout(self):
+        pool = self.get_pool(max_size=2, timeout=0.05)
+        connections = [pool.checkout(), pool.checkout()]
+        with self.assertRaises(PoolTimeout):
+            pool.checkout()
+
+        stats = pool.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['utilization'], 1)
+        self.assertEqual(stats['size'], 2)
+        self.assertTrue(all(not connection.closed for connection in connections))
+
+    def test_waits_for_checkin(self):
+        pool = self.get_pool(max_size=1, timeout=5)
+        connection = pool.checkout()
+        threading.Timer(0.05, pool.checkin, [connection]).start()
+
+        self.assertIs(pool.checkout(), connection)
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['max_wait'], 0)
+
+    def test_recycled_after_max_uses(self):
+        pool = self.get_pool(max_uses=2)
+        first = pool.checkout()
+        pool.checkin(first)
+        self.assertIs(pool.checkout(), first)
+        pool.checkin(first)
+
+        self.assertTrue(first.closed)
+        self.assertIsNot(pool.checkout(), first)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_dead_connection_is_replaced(self):
+        pool = self.get_pool(check_after=0)
+        connection = pool.checkout()
+        pool.checkin(connection)
+        connection.alive = False
+
+        self.assertIsNot(pool.checkout(), connection)
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['failed_checks'], 1)
+
+    def test_recently_used_connection_is_not_checked(self):
+        pool = self.get_pool(check_after=60)
+        connection = pool.checkout()
+        pool.checkin(connection)
+        connection.alive = False
+
+        self.assertIs(pool.checkout(), connection)
+
+    def test_unusable_connection_is_discarded(self):
+        pool = self.get_pool()
+        connection = pool.checkout()
+        pool.checkin(connection, reusable=False)
+
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_spare_connections_are_closed_when_idle(self):
+        pool = self.get_pool(min_size=1, max_idle=0.05)
+        connections = [pool.checkout() for _ in range(3)]
+        pool.checkin(connections[0])
+        pool.checkin(connections[1])
+        time.sleep(0.1)
+        pool.checkin(connections[2])
+
+        self.assertEqual([connection.closed for connection in connections], [True, True, False])
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_close(self):
+        pool = self.get_pool()
+        idle, in_use = pool.checkout(), pool.checkout()
+        pool.checkin(idle)
+        pool.close()
+        self.assertTrue(idle.closed)
+
+        pool.checkin(in_use)
+        self.assertTrue(in_use.closed)
+
+    def test_registry(self):
+        self.addCleanup(close_pool, 'test')
+        pool = get_pool('test', 'params', lambda: self.get_pool(min_size=2))
+        self.assertIs(get_pool('test', 'params', self.get_pool), pool)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+        # New connection parameters replace the pool
+        other = get_pool('test', 'other params', self.get_pool)
+        self.assertIsNot(other, pool)
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+class DatabasePoolStatsTestCase(APITestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + AuthToken.objects.create(user=self.user)[1])
+
+    def test_stats(self):
+        self.addCleanup(close_pool, 'test')
+        get_pool('test', 'params', lambda: ConnectionPool(connect=FakeConnection, check=check_fake_connection))
+        self.user.is_staff = True
+        self.user.save()
+
+        response = self.client.get(reverse('chat-pool'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['test']['idle'], 1)
+        self.assertEqual(response.data['test']['utilization'], 0)
+
+    def test_stats_fail_not_staff(self):
+        response = self.client.get(reverse('chat-pool'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class WorkerServerTestCase(SimpleTestCase):
+
+    def start(self, application, **options):
+        sock = socket.create_server(('127.0.0.1', 0))
+        sock.setblocking(False)
+        server = WorkerServer(sock, application, **options)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(server.stop)
+        return server, thread, f'http://127.0.0.1:{sock.getsockname()[1]}/'
+
+    def test_recycle_after_max_requests(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        server, thread, url = self.start(application, max_requests=2)
+        for _ in range(2):
+            with urlopen(url, timeout=5) as response:
+                self.assertEqual(response.read(), b'ok')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(server.handled, 2)
+
+    def test_stop_finishes_requests(self):
+        started, release = threading.Event(), threading.Event()
+
+        def application(environ, start_response):
+            started.set()
+            release.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        server, thread, url = self.start(application)
+        responses = []
+        request = threading.Thread(target=lambda: responses.append(urlopen(url, timeout=5).read()))
+        request.start()
+        self.assertTrue(started.wait(5))
+
+        server.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        release.set()
+        server.server_close()
+        request.join(5)
+        self.assertEqual(responses, [b'ok'])
+
+    def test_idle_connection_times_out(self):
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        server, thread, url = self.start(application, threads=1, request_timeout=0.2)
+        idle = socket.create_connection(server.socket.getsockname())
+        self.addCleanup(idle.close)
+        with mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+            with urlopen(url, timeout=5) as response:
+                self.assertEqual(response.read(), b'ok')
+            # Closed by the server
+            idle.settimeout(5)
+            self.assertEqual(idle.recv(1), b'')
+        self.assertEqual(stderr.getvalue(), '')
+
+    def test_serve_fail_bind(self):
+        with self.assertRaises(CommandError):
+            call_command('serve', bind='localhost')
+
+
+class ChatMembershipTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.mock_user = User.objects.create_user(username='mock', password='mock')
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+
+    def test_has_participant(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(Chat.objects.has_participant(self.chat.pk, self.user))
+
+    def test_has_participant_not_member(self):
+        self.assertFalse(Chat.objects.has_participant(self.chat.pk, self.mock_user))
+
+    def test_has_participant_missing_chat(self):
+        self.assertFalse(Chat.objects.has_participant(0, self.user))
+
+
+class FastRepresentationTestCase(TestCase):
+
+    texts = ['Hello!', 'Привет 👋', 'quotes " and \\ backslashes', 'line\nbreaks\tand\x01controls',
+             'separators \u2028 \u2029', '']
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='tést', password='test')
+        self.chat = Chat.objects.create(creator=self.user)
+        self.chat.participants.add(self.user)
+        Message.objects.bulk_send([Message(chat=self.chat, author=self.user, text=text) for text in self.texts])
+        self.orjson = renderers.orjson
+
+    def tearDown(self):
+        renderers.orjson = self.orjson
+
+    def assert_same_output(self, fast, slow):
+        expected = JSONRenderer().render(slow)
+        self.assertEqual(renderers.FastJSONRenderer().render(fast), expected)
+        renderers.orjson = None
+        self.assertEqual(renderers.FastJSONRenderer().render(fast), expected)
+
+    def test_messages(self):
+        messages = Message.objects.filter(chat=self.chat).order_by('id')
+        self.assert_same_output(represent_messages(messages.values(*MESSAGE_VALUES)),
+                                MessagePreviewSerializer(messages, many=True).data)
+
+    def test_chats(self):
+        chats = Chat.objects.order_by('id')
+        self.assert_same_output(represent_chats(chats.values(*CHAT_PREVIEW_VALUES)),
+                                ChatPreviewSerializer(chats, many=True).data)
+
+
+class LoadTestTestCase(APITransactionTestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        tail_cache.clear()
+
+    def test_report(self):
+        out = StringIO()
+        call_command('loadtest', requests=40, concurrency=1, users=4, chats=2, messages=10, stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['requests'], 40)
+        self.assertEqual(sum(endpoint['requests'] for endpoint in report['endpoints'].values()), 40)
+        for name, endpoint in report['endpoints'].items():
+            self.assertEqual(endpoint['errors'], 0, name)
+            self.assertGreater(endpoint['queries_per_request'], 0, name)
+            self.assertLessEqual(endpoint['latency_ms']['p50'], endpoint['latency_ms']['p99'])
+
+        # Everything it created is removed
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Chat.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+    def test_mix(self):
+        out = StringIO()
+        call_command('loadtest', requests=5, concurrency=1, users=2, chats=1, messages=0, mix='chat-user',
+                     stdout=out)
+        self.assertEqual(list(json.loads(out.getvalue())['endpoints']), ['chat-user'])
+
+    @override_settings(TOKEN_LIMIT_PER_USER=1)
+    def test_logins_keep_tokens(self):
+        out = StringIO()
+        call_command('loadtest', requests=20, concurrency=1, users=2, chats=1, messages=0,
+                     mix='login=1,chat-user=1', stdout=out)
+        for name, endpoint in json.loads(out.getvalue())['endpoints'].items():
+            self.assertEqual(endpoint['errors'], 0, name)
+
+    def test_mix_fail_unknown_endpoint(self):
+        with self.assertRaises(CommandError):
+            call_command('loadtest', mix='send-message=1,logout=1')
+
+
+class SeedTestCase(TestCase):
+
+    def seed(self, **options):
+        call_command('seed', stdout=StringIO(), **{'users': 20, 'chats': 10, 'messages': 300,
+                                                   'max_participants': 8, 'seed': 1, **options})
+
+    def describe(self, prefix):
+        """Chats in the order of their ids, with the numbers of their participants and their messages"""
+        def number(username):
+            return int(username[len(prefix):])
+
+        chats = []
+        for chat in Chat.objects.filter(creator__username__startswith=prefix).order_by('pk'):
+            usernames = chat.participants.values_list('username', flat=True)
+            participants = sorted(number(username) for username in usernames)
+            messages = list(chat.messages.order_by('seq').values_list('author__username', 'text'))
+            chats.append((number(chat.creator.username), participants,
+                          [(number(author), text) for author, text in messages]))
+        return chats
+
+    def test_seed(self):
+        self.seed()
+        self.assertEqual(User.objects.count(), 20)
+        self.assertEqual(Chat.objects.count(), 10)
+        self.assertTrue(User.objects.get(username='seed0').check_password('password'))
+
+        counts = sorted(Message.objects.values('chat_id').annotate(count=Count('*'))
+                                       .values_list('count', flat=True))
+        self.assertGreater(counts[-1], counts[0] * 3)
+        self.assertLessEqual(sum(counts), 300)
+
+        for chat in Chat.objects.all():
+            members = set(chat.memberships.values_list('user_id', flat=True))
+            self.assertGreaterEqual(len(members), 2)
+            self.assertIn(chat.creator_id, members)
+
+            messages = list(chat.messages.order_by('seq'))
+            self.assertEqual([message.seq for message in messages], list(range(1, len(messages) + 1)))
+            self.assertEqual(sorted(messages, key=lambda message: message.created_at), messages)
+            self.assertTrue({message.author_id for message in messages} <= members)
+            self.assertEqual(chat.last_seq, len(messages))
+            if messages:
+                self.assertEqual(chat.last_message_id, messages[-1].pk)
+                self.assertGreater(messages[0].created_at, chat.created_at)
+                self.assertLess(messages[-1].created_at, timezone.now())
+
+    def test_seed_deterministic(self):
+        self.seed(prefix='first', seed=7)
+        self.seed(prefix='second', seed=7)
+        self.seed(prefix='third', seed=8)
+        self.assertEqual(self.describe('first'), self.describe('second'))
+        self.assertNotEqual(self.describe('first'), self.describe('third'))
+
+    def test_seed_fail_existing_prefix(self):
+        self.seed(chats=1, messages=0)
+        with self.assertRaises(CommandError):
+            self.seed()
+
+
+class ExplainQueriesTestCase(TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('explainqueries', stdout=out)
+        self.assertNotIn('FAIL', out.getvalue())
+        for name in ('history-version', 'chat-list-version', 'chat-list', 'inbox'):
+            self.assertIn(f'OK   {name}', out.getvalue())
+
+    def test_unread_count_seeks_past_read_marker(self):
+        out = StringIO()
+        call_command('explainqueries', verbosity=2, stdout=out)
+        self.assertIn('chats_message_unread_idx', out.getvalue())
@@ -1,11 +1,20 @@
 from django.urls import path
 
-from chats.api import ChatCreateAPI, ChatHistoryAPI, ChatUserAPI, MessageCreateAPI
+from chats.api import ChatBootstrapAPI, ChatCacheStatsAPI, ChatCreateAPI, ChatExportAPI, ChatHistoryAPI, ChatInboxAPI, \
+    ChatReadAPI, ChatSyncAPI, ChatUserAPI, DatabasePoolStatsAPI, MessageBatchCreateAPI, MessageCreateAPI
 
 
 urlpatterns = [
     path('api/chats/create', ChatCreateAPI.as_view(), name='create-chat'),
+    path('api/chats/send_messages', MessageBatchCreateAPI.as_view(), name='send-messages'),
     path('api/chats/<pk>/send_message', MessageCreateAPI.as_view(), name='send-message'),
     path('api/chats/<pk>/history', ChatHistoryAPI.as_view(), name='chat-history'),
-    path('api/chats/user', ChatUserAPI.as_view(), name='chat-user')
+    path('api/chats/<pk>/export', ChatExportAPI.as_view(), name='chat-export'),
+    path('api/chats/<pk>/read', ChatReadAPI.as_view(), name='chat-read'),
+    path('api/chats/user', ChatUserAPI.as_view(), name='chat-user'),
+    path('api/chats/inbox', ChatInboxAPI.as_view(), name='chat-inbox'),
+    path('api/chats/sync', ChatSyncAPI.as_view(), name='chat-sync'),
+    path('api/chats/bootstrap', ChatBootstrapAPI.as_view(), name='chat-bootstrap'),
+    path('api/chats/cache', ChatCacheStatsAPI.as_view(), name='chat-cache'),
+    path('api/chats/pool', DatabasePoolStatsAPI.as_view(), name='chat-pool'),
 ]
\ No newline at end of file
@@ -2,6 +2,7 @@
 ASGI config for oil_test project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are served by Django, WebSocket connections by ``chats.consumers``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -12,5 +13,15 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'oil_test.settings')
+os.environ.setdefault('ASYNC_AUTH_VIEWS', '1')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Models can only be imported once the apps are loaded by the line above
+from chats.consumers import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -0,0 +1,71 @@
+"""
+PostgreSQL backend that keeps the connections of every process in a pool instead of opening one per request.
+
+Django still closes its connection at the end of every request (with the default `CONN_MAX_AGE = 0`),
+closing only hands it back to the pool of the database alias. The pool is set with the `POOL` entry
+of the database settings, see `ConnectionPool` for the meaning of the values.
+"""
+from django.db.backends.postgresql import base, creation
+from psycopg2 import extensions
+
+from oil_test.postgresql_pool.pool import ConnectionPool, PoolTimeout, close_pool, get_pool
+
+Database = base.Database
+
+
+def check_connection(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle connections of the pool would keep the test database busy
+        close_pool(self.connection.alias)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get('POOL', {})
+        return get_pool(self.alias, repr(sorted(conn_params.items())), lambda: ConnectionPool(
+            # A wrapper of its own opens the connections, as the pool outlives this one and is shared by threads
+            connect=lambda: base.DatabaseWrapper(self.settings_dict, self.alias).get_new_connection(conn_params),
+            check=check_connection,
+            min_size=options.get('MIN_SIZE', 1),
+            max_size=options.get('MAX_SIZE', 10),
+            timeout=options.get('TIMEOUT', 5),
+            max_uses=options.get('MAX_USES'),
+            max_idle=options.get('MAX_IDLE'),
+            check_after=options.get('CHECK_AFTER', 0),
+        ))
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        try:
+            connection = self.pool.checkout()
+        except PoolTimeout as e:
+            raise Database.OperationalError(str(e)) from e
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.checkin(self.connection, reusable=self.reset_connection())
+
+    def reset_connection(self):
+        """Rolls back whatever the connection was left in, tells whether it can be handed out again"""
+        if self.connection.closed:
+            return False
+        status = self.connection.get_transaction_status()
+        if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                self.connection.rollback()
+            except Database.Error:
+                return False
+            return True
+        return status == extensions.TRANSACTION_STATUS_IDLE
@@ -0,0 +1,238 @@
+import os
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    __slots__ = ('connection', 'uses', 'released_at')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.uses = 0
+        self.released_at = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of at least `min_size` and at most `max_size` open connections.
+
+    A checkout waits for up to `timeout` seconds once all the connections are in use. A connection
+    that was idle for `check_after` seconds is checked with `check` before it is handed out again,
+    one is closed after `max_uses` checkouts, and the idle ones beyond `min_size` after `max_idle` seconds
+    """
+
+    def __init__(self, connect, check, min_size=1, max_size=10, timeout=5, max_uses=None, max_idle=None,
+                 check_after=0):
+        self.connect = connect
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.pid = os.getpid()
+        self.closing = False
+
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        # Connections are reused newest first, so the spare ones get idle long enough to be closed
+        self.idle = deque()
+        self.in_use = {}
+        self.size = 0
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.peak_in_use = 0
+        self.opened = 0
+        self.closed = 0
+        self.failed_checks = 0
+
+    def fill(self):
+        """Opens connections up to `min_size`"""
+        while True:
+            with self.lock:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            item = self.open()
+            with self.lock:
+                self.idle.appendleft(item)
+                self.released.notify()
+
+    def open(self):
+        try:
+            connection = self.connect()
+        except Exception:
+            with self.lock:
+                self.size -= 1
+                self.released.notify()
+            raise
+        with self.lock:
+            self.opened += 1
+        return PooledConnection(connection)
+
+    def discard(self, item):
+        with self.lock:
+            self.size -= 1
+            self.closed += 1
+            self.released.notify()
+        try:
+            item.connection.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        while True:
+            item = self.acquire()
+            if item is None:
+                item = self.open()
+            elif time.monotonic() - item.released_at >= self.check_after:
+                try:
+                    self.check(item.connection)
+                except Exception:
+                    with self.lock:
+                        self.failed_checks += 1
+                    self.discard(item)
+                    continue
+
+            item.uses += 1
+            with self.lock:
+                self.in_use[id(item.connection)] = item
+                self.peak_in_use = max(self.peak_in_use, len(self.in_use))
+            return item.connection
+
+    def acquire(self):
+        """An idle connection, or None once a new one may be opened"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self.lock:
+            waited = False
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f'No database connection was released within {self.timeout} seconds, '
+                                      f'all {self.max_size} are in use')
+                waited = True
+                self.released.wait(remaining)
+
+            self.checkouts += 1
+            if waited:
+                wait = time.monotonic() - started
+                self.waits += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+            return None
+
+    def checkin(self, connection, reusable=True):
+        with self.lock:
+            item = self.in_use.pop(id(connection), None)
+        if item is None:
+            # Not checked out of this pool, e.g. opened before the pool was replaced
+            connection.close()
+            return
+
+        if not reusable or self.closing or (self.max_uses and item.uses >= self.max_uses):
+            self.discard(item)
+            return
+
+        item.released_at = time.monotonic()
+        expired = []
+        with self.lock:
+            self.idle.append(item)
+            if self.max_idle is not None:
+                while len(self.idle) > 1 and self.size - len(expired) > self.min_size \
+                        and item.released_at - self.idle[0].released_at >= self.max_idle:
+                    expired.append(self.idle.popleft())
+            self.released.notify()
+        for stale in expired:
+            self.discard(stale)
+
+    def close(self):
+        """Closes the idle connections, the ones in use are closed as they are checked in"""
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+            self.closing = True
+        for item in idle:
+            self.discard(item)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': len(self.in_use),
+                'peak_in_use': self.peak_in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'utilization': len(self.in_use) / self.max_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'timeouts': self.timeouts,
+                'opened': self.opened,
+                'closed': self.closed,
+                'failed_checks': self.failed_checks,
+            }
+
+
+pools = {}
+pools_lock = threading.Lock()
+# Connections inherited over fork() share their sockets with the parent process, closing them
+# in a child would end the sessions of the parent, so they are kept here and never used
+inherited_pools = []
+
+
+def get_pool(alias, key, factory):
+    """The pool of the database alias for the connection parameters `key`, made with `factory()` if needed"""
+    with pools_lock:
+        if any(pool.pid != os.getpid() for _, pool in pools.values()):
+            inherited_pools.extend(pool for _, pool in pools.values())
+            pools.clear()
+
+        current = pools.get(alias)
+        if current is not None and current[0] == key:
+            return current[1]
+        pool = factory()
+        pools[alias] = (key, pool)
+
+    # The parameters changed, e.g. to point to a test database
+    if current is not None:
+        current[1].close()
+    pool.fill()
+    return pool
+
+
+def close_pool(alias):
+    with pools_lock:
+        current = pools.pop(alias, None)
+    if current is not None:
+        current[1].close()
+
+
+def close_pools():
+    """Closes the idle connections of every pool, e.g. before the process forks"""
+    with pools_lock:
+        current = list(pools.values())
+        pools.clear()
+    for _, pool in current:
+        pool.close()
+
+
+def get_pool_stats():
+    with pools_lock:
+        return {alias: pool.stats() for alias, (_, pool) in pools.items() if pool.pid == os.getpid()}
@@ -0,0 +1,99 @@
+import random
+
+from asgiref.local import Local
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.permissions import SAFE_METHODS
+
+
+state = Local()
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def use_replica():
+    """Sends the reads of the current thread or task to a random replica, if any is configured"""
+    replicas = get_replicas()
+    state.replica = random.choice(replicas) if replicas else None
+
+
+def use_primary():
+    state.replica = None
+
+
+def pin_key(user):
+    return f'replicas:pinned:{user.pk}'
+
+
+def pin_to_primary(user):
+    """Keeps the reads of the user on the primary for a while, so that they see their own writes"""
+    cache.set(pin_key(user), True, getattr(settings, 'REPLICA_PIN_SECONDS', 5))
+
+
+def is_pinned(user):
+    return cache.get(pin_key(user), False)
+
+
+class ReplicaRouter:
+    """
+    Writes always go to the primary. Reads go to a replica only inside the views that opted in
+    with `ReplicaReadMixin`, everything else, authentication included, reads from the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(state, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        # Otherwise Django would write an object back to the replica it was read from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in get_replicas():
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Lets the router send the reads of a DRF view to a replica once the request is authenticated,
+    unless the user wrote something within the last `REPLICA_PIN_SECONDS`
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if get_replicas() and not is_pinned(request.user):
+            use_replica()
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            use_primary()
+
+
+class ReplicaPinningMiddleware(MiddlewareMixin):
+    """
+    Pins the authors of successful unsafe requests to the primary.
+    It works with async views too, so that it does not run them in the thread of the sync code under ASGI
+    """
+
+    def process_response(self, request, response):
+        # DRF hands the user it authenticated over to the Django request
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and get_replicas() \
+                and user is not None and user.is_authenticated:
+            pin_to_primary(user)
+        return response
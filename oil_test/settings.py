@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,10 +38,53 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + CUSTOM_APPS
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'knox.auth.TokenAuthentication',
+        'accounts.auth.CachedTokenAuthentication',
     ),
 }
 
+REST_KNOX = {
+    'AUTO_REFRESH': bool(int(os.environ.get('TOKEN_AUTO_REFRESH', 0))),
+    # The expiry of a token is written at most once per this many seconds
+    'MIN_REFRESH_INTERVAL': 300,
+}
+
+# Validated tokens are cached in memory of every process,
+# so a token removed by another process is still accepted for up to `TOKEN_CACHE_TTL` seconds
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_MAX_SIZE = 10000
+
+# Register and login hash passwords off the event loop when served through ASGI.
+# Requests beyond `HASHING_POOL_MAX_PENDING` get 503 instead of waiting, 0 admits every request
+ASYNC_AUTH_VIEWS = bool(int(os.environ.get('ASYNC_AUTH_VIEWS', 0)))
+HASHING_POOL_WORKERS = os.cpu_count()
+HASHING_POOL_MAX_PENDING = HASHING_POOL_WORKERS * 4
+
+# Logging in with more live tokens than this evicts the oldest ones of the user
+TOKEN_LIMIT_PER_USER = 10
+
+
+# Publish/subscribe layer used to push new messages over WebSockets,
+# the in-process broker only reaches the clients connected to the same process
+CHATS_PUBSUB_BROKER = os.environ.get('CHATS_PUBSUB_BROKER', 'chats.pubsub.InProcessBroker')
+
+# Upper bound in seconds for how long `api/chats/sync` may wait for new messages
+CHATS_SYNC_MAX_TIMEOUT = 30
+# Meanwhile the database is checked every that many seconds, as messages sent through other processes
+# are not announced by the in-process broker
+CHATS_SYNC_POLL_INTERVAL = 1
+
+# Every process keeps the newest messages of recently read chats in memory to serve the first page of their history.
+# `CHATS_TAIL_CACHE_MESSAGES` should exceed the largest page size, 0 chats disables the cache
+CHATS_TAIL_CACHE_CHATS = 1000
+CHATS_TAIL_CACHE_MESSAGES = 256
+
+# Opt-in write-behind ingestion: concurrent `send_message` requests of a process wait for up to
+# `CHATS_GROUP_COMMIT_WINDOW` seconds, or `CHATS_GROUP_COMMIT_MAX_BATCH` messages, and are inserted in one transaction.
+# It only pays off with workers serving requests in several threads
+CHATS_GROUP_COMMIT = bool(int(os.environ.get('CHATS_GROUP_COMMIT', 0)))
+CHATS_GROUP_COMMIT_WINDOW = 0.005
+CHATS_GROUP_COMMIT_MAX_BATCH = 100
+
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -50,6 +94,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'oil_test.replicas.ReplicaPinningMiddleware',
 ]
 
 ROOT_URLCONF = 'oil_test.urls'
@@ -78,15 +123,58 @@ WSGI_APPLICATION = 'oil_test.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        # The PostgreSQL backend, with the connections of every process kept open in a pool between requests
+        'ENGINE': 'oil_test.postgresql_pool',
         'HOST': 'db',
         'NAME': os.environ.get('DB_NAME'),
         'USER': os.environ.get('DB_USER'),
         'PORT': os.environ.get('DB_PORT'),
         'PASSWORD': os.environ.get('DB_PASSWORD'),
+        'POOL': {
+            'MIN_SIZE': int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+            # Every thread serving requests holds one connection at most
+            'MAX_SIZE': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+            # Seconds to wait for a connection once all of them are in use
+            'TIMEOUT': 5,
+            # Connections are closed after that many requests, and the spare ones after that many idle seconds
+            'MAX_USES': 5000,
+            'MAX_IDLE': 300,
+            # Connections idle for that many seconds are checked with `SELECT 1` before they are reused
+            'CHECK_AFTER': 10,
+        },
     }
 }
 
+# Read replicas of the primary, as a comma separated list of hosts. Chat history and chat lists are read
+# from them, except for users who wrote something within the last `REPLICA_PIN_SECONDS`.
+# Pins are kept in the default cache, it has to be shared by all the processes for them to hold everywhere
+DATABASE_REPLICAS = []
+for number, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'HOST': host.strip(), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica{number}')
+
+# Chats, their memberships and messages can be spread over several databases by the hash of the chat id,
+# given as a comma separated list of hosts. Users, tokens and the ids of new chats stay on the default database.
+# The number of shards cannot change once chats were created, as that would move most of them
+CHATS_SHARDS = []
+for number, host in enumerate(filter(None, os.environ.get('DB_SHARD_HOSTS', '').split(',')), 1):
+    DATABASES[f'shard{number}'] = {**DATABASES['default'], 'HOST': host.strip()}
+    CHATS_SHARDS.append(f'shard{number}')
+CHATS_SHARDS = CHATS_SHARDS or ['default']
+
+# The sharding tests spread the chats over these two databases next to the default one.
+# They are only declared when running the tests, which create them for those tests alone
+TEST_CHATS_SHARDS = ['test_shard1', 'test_shard2']
+if sys.argv[1:2] == ['test']:
+    for alias in TEST_CHATS_SHARDS:
+        DATABASES[alias] = {**DATABASES['default'], 'TEST': {'NAME': f'test_{DATABASES["default"]["NAME"]}_{alias}'}}
+
+# Threads that query all the shards at once, e.g. for the list of chats of a user
+CHATS_SHARD_WORKERS = 16
+
+DATABASE_ROUTERS = ['chats.sharding.ChatShardRouter', 'oil_test.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators